@@ -0,0 +1,168 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import hashlib
+import io
+import json
+import os
+import threading
+import urllib2
+from urlparse import urlparse
+
+# Pillow is optional; without it artwork is used exactly as downloaded
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# A content-addressed store of downloaded artwork, keyed by a hash of the artwork URL.  Each URL is
+# downloaded (or revalidated using the saved `ETag`/`Last-Modified` headers) at most once per run,
+# no matter how many cards share it.
+class ArtworkCache(object):
+    def __init__(self, directory, offline=False):
+        self.directory = directory
+        self.offline = offline
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # URLs that have already been fetched/revalidated during this run
+        self.fresh = set()
+
+        # One lock per URL, so that concurrent cards sharing the same artwork wait for a single
+        # download instead of each starting their own
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    # Return the name of the cached file for the given URL (the extension is preserved so that
+    # the file is still recognized as an image).
+    def filename(self, url):
+        ext = os.path.splitext(urlparse(url).path)[1].lower()
+        if ext not in ['.jpg', '.jpeg', '.png', '.gif']:
+            ext = '.jpg'
+        return hashlib.sha1(url).hexdigest() + ext
+
+    # Return the path to an up-to-date local copy of the artwork at the given URL, downloading it
+    # first if needed.
+    def fetch(self, url):
+        path = os.path.join(self.directory, self.filename(url))
+
+        with self.locks_lock:
+            lock = self.locks.setdefault(url, threading.Lock())
+
+        with lock:
+            if url in self.fresh:
+                return path
+            if self.offline and os.path.exists(path):
+                self.fresh.add(url)
+                return path
+
+            self.download(url, path)
+            self.fresh.add(url)
+            return path
+
+    def download(self, url, path):
+        info_path = path + '.json'
+        request = urllib2.Request(url)
+
+        # Ask the server to only send the artwork if it has changed since we last downloaded it
+        if os.path.exists(path) and os.path.exists(info_path):
+            with open(info_path) as f:
+                info = json.load(f)
+            if info.get('etag'):
+                request.add_header('If-None-Match', info['etag'])
+            if info.get('last_modified'):
+                request.add_header('If-Modified-Since', info['last_modified'])
+
+        print(url)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                # Our copy is still current
+                return
+            raise
+        except urllib2.URLError as e:
+            if os.path.exists(path):
+                print('Failed to revalidate artwork ({0}); using cached copy'.format(e.reason))
+                return
+            raise
+
+        data = response.read()
+
+        # Write to a temporary file first so that an interrupted download never leaves a
+        # truncated image in the cache
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+
+        with open(info_path, 'w') as f:
+            json.dump({
+                'url': url,
+                'etag': response.info().getheader('ETag'),
+                'last_modified': response.info().getheader('Last-Modified')
+            }, f)
+
+
+# Return true if artwork can be resized (which requires Pillow).
+def can_resize():
+    return Image is not None
+
+
+# Write a copy of the image at `path` into `out_dir` that is at most `pixels` pixels on each side,
+# recompressed as a JPEG of the given quality (or as an optimized PNG, if the image has
+# transparency), and return its file name.  If the image is already small enough and the original
+# file is smaller than the recompressed one, the original data is kept.  An existing copy that is
+# newer than `path` is reused.
+def resize_artwork(path, out_dir, pixels, quality):
+    image = Image.open(path)
+    transparent = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    base = '{0}-{1}px'.format(os.path.splitext(os.path.basename(path))[0], pixels)
+    if transparent:
+        (name, format) = (base + '.png', 'PNG')
+    else:
+        (name, format) = ('{0}-q{1}.jpg'.format(base, quality), 'JPEG')
+    out_path = os.path.join(out_dir, name)
+    if os.path.exists(out_path) and os.path.getmtime(out_path) >= os.path.getmtime(path):
+        return name
+
+    # (`thumbnail` only ever shrinks the image, and keeps its aspect ratio)
+    image = image.convert('RGBA' if transparent else 'RGB')
+    resized = image.size[0] > pixels or image.size[1] > pixels
+    image.thumbnail((pixels, pixels), Image.ANTIALIAS)
+    data = io.BytesIO()
+    if transparent:
+        image.save(data, format, optimize=True)
+    else:
+        image.save(data, format, quality=quality, optimize=True, progressive=True)
+    data = data.getvalue()
+
+    if not resized and Image.open(path).format == format and os.path.getsize(path) <= len(data):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+    temp_path = out_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.rename(temp_path, out_path)
+    return name
@@ -0,0 +1,144 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Benchmarks `qrgen` card generation and `qrplay` command handling against local stand-ins for
+# `node-sonos-http-api` and Spotify (see `stubs.py`).  No network access, Sonos system, or external
+# tools are needed, though `qrgen` does need the `qrcode` package (and Pillow for
+# `--generate-images`).
+#
+#   % python benchmarks/bench.py --cards 10,100,1000 --latency 0.02 --jobs 8
+#
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubs
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+from latency import format_latencies
+
+arg_parser = argparse.ArgumentParser(description='Benchmarks `qrgen` and `qrplay` against local stub servers.')
+arg_parser.add_argument('--cards', default='10,100,1000', help='comma-separated list of deck sizes to generate')
+arg_parser.add_argument('--scans', type=int, default=200, help='the number of codes to replay through `qrplay`')
+arg_parser.add_argument('--jobs', type=int, default=8, help='the number of `qrgen` worker threads')
+arg_parser.add_argument('--generate-images', action='store_true', help='also generate card images and a PDF')
+arg_parser.add_argument('--latency', type=float, default=0.01, help='the latency (in seconds) added to each stub response')
+arg_parser.add_argument('--jitter', type=float, default=0.0, help='the maximum random variation (in seconds) in the added latency')
+arg_parser.add_argument('--error-rate', type=float, default=0.0, help='the fraction of stub requests that fail with a server error')
+args = arg_parser.parse_args()
+
+
+# Run a script from the repo in `workdir` and return (elapsed seconds, peak RSS in MB).
+def run_script(workdir, script_args, env):
+    start = time.time()
+    with open(os.path.join(workdir, 'output.log'), 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.join(repo_dir, script_args[0])] + script_args[1:],
+                                   cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        (pid, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError('{0} failed; see {1}'.format(script_args[0], os.path.join(workdir, 'output.log')))
+    # `ru_maxrss` is in kilobytes on Linux
+    return (elapsed, usage.ru_maxrss / 1024.0)
+
+
+# Set up a fake cached Spotify token so that `spotipy` doesn't prompt for authorization.
+def spotify_env(workdir):
+    with open(os.path.join(workdir, '.cache-bench'), 'w') as f:
+        json.dump({'access_token': 'bench', 'token_type': 'Bearer', 'expires_in': 3600,
+                   'expires_at': int(time.time()) + 24 * 60 * 60, 'scope': 'user-library-read',
+                   'refresh_token': 'bench'}, f)
+    env = dict(os.environ)
+    env['SPOTIPY_CLIENT_ID'] = 'bench'
+    env['SPOTIPY_CLIENT_SECRET'] = 'bench'
+    env['SPOTIPY_REDIRECT_URI'] = 'http://localhost/'
+    return env
+
+
+def bench_qrgen(bridge, spotify, count):
+    workdir = tempfile.mkdtemp(prefix='qrbench-')
+    try:
+        with open(os.path.join(workdir, 'deck.txt'), 'w') as f:
+            f.write('\n'.join(stubs.synthetic_deck(count)) + '\n')
+        shutil.copyfile(os.path.join(repo_dir, 'cards.css'), os.path.join(workdir, 'cards.css'))
+
+        script_args = ['qrgen.py', '--input', 'deck.txt', '--hostname', '127.0.0.1', '--port', str(bridge.server_address[1]),
+                       '--spotify-username', 'bench', '--spotify-api-url', 'http://127.0.0.1:{0}/v1/'.format(spotify.server_address[1]),
+                       '--jobs', str(args.jobs), '--cache-dir', 'cache', '--qr-backend', 'builtin', '--stats-file', 'stats.json']
+        if args.generate_images:
+            script_args += ['--pdf']
+
+        # The first run starts from empty caches; the second shows the incremental rebuild
+        for run in ['cold', 'warm']:
+            del bridge.requests[:]
+            del spotify.requests[:]
+            (elapsed, peak_mb) = run_script(workdir, script_args, spotify_env(workdir))
+            with open(os.path.join(workdir, 'stats.json')) as f:
+                stats = json.load(f)
+
+            print('qrgen {0:>6} cards ({1}): {2:8.2f}s  {3:8.1f} cards/s  peak {4:6.1f}MB  {5} bridge + {6} Spotify requests'.format(
+                count, run, elapsed, count / elapsed, peak_mb, len(bridge.requests), len(spotify.requests)))
+            for stage in ['metadata', 'qrencode', 'artwork', 'image']:
+                if stage in stats['stages']:
+                    print('  {0:<10} {1}'.format(stage, format_latencies(stats['stages'][stage])))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def bench_qrplay(bridge, count):
+    workdir = tempfile.mkdtemp(prefix='qrbench-')
+    try:
+        with open(os.path.join(workdir, 'scans.txt'), 'w') as f:
+            f.write('\n'.join(stubs.synthetic_scans(count)) + '\n')
+
+        del bridge.requests[:]
+        # (De-duplication is disabled so that every scan reaches the bridge)
+        script_args = ['qrplay.py', '--debug-file', 'scans.txt', '--debug-delay', '0', '--skip-load',
+                       '--hostname', '127.0.0.1', '--port', str(bridge.server_address[1]),
+                       '--dedupe-window', 'cmd:=0', '--dedupe-window', 'lib:=0', '--dedupe-window', 'spotify:=0']
+        (elapsed, peak_mb) = run_script(workdir, script_args, dict(os.environ))
+
+        print('qrplay {0:>5} scans: {1:8.2f}s  {2:8.1f} scans/s  peak {3:6.1f}MB  {4} bridge requests'.format(
+            count, elapsed, count / elapsed, peak_mb, len(bridge.requests)))
+        print('  {0:<10} {1}'.format('bridge', format_latencies([seconds for (path, seconds) in bridge.requests])))
+    finally:
+        shutil.rmtree(workdir)
+
+
+config = stubs.StubConfig(args.latency, args.jitter, args.error_rate)
+bridge = stubs.start_server(stubs.BridgeHandler, config, library_size=1000)
+artwork_base_url = 'http://127.0.0.1:{0}'.format(bridge.server_address[1])
+spotify = stubs.start_server(stubs.SpotifyHandler, config, artwork_base_url=artwork_base_url)
+
+for count in [int(c) for c in args.cards.split(',')]:
+    bench_qrgen(bridge, spotify, count)
+bench_qrplay(bridge, args.scans)
+
+bridge.shutdown()
+spotify.shutdown()
@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Measures in-process QR decoding throughput at a range of frame sizes, by replaying a directory of
+# recorded camera frames (or, without one, synthetic frames in which cards drift in and out of
+# view), so that decode rate and CPU use can be tuned without a camera.
+#
+#   % python benchmarks/decode_bench.py --frames recorded/ --sizes 640x480,300x200,160x120
+#
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import framesource
+from framesource import parse_roi, parse_size
+import qrencoder
+
+arg_parser = argparse.ArgumentParser(description='Benchmarks in-process QR decoding of camera frames.')
+arg_parser.add_argument('--frames', help='a directory of recorded frames (by default, synthetic frames are generated)')
+arg_parser.add_argument('--count', type=int, default=200, help='the number of synthetic frames')
+arg_parser.add_argument('--sizes', default='640x480,300x200,160x120', help='the comma-separated frame sizes to decode at')
+arg_parser.add_argument('--roi', type=parse_roi, metavar='X,Y,WIDTH,HEIGHT', help='only decode this region of each frame')
+arg_parser.add_argument('--loops', type=int, default=3, help='the number of passes over the frames')
+args = arg_parser.parse_args()
+
+
+# Write `count` 640x480 frames: a noisy background, with a card held in view (and moving slightly)
+# for runs of 10 frames, separated by 10 empty frames.
+def synthetic_frames(directory, count):
+    from PIL import Image
+
+    encoder = qrencoder.QREncoder('auto')
+    random.seed(1)
+    noise = Image.frombytes('L', (640, 480), ''.join(chr(random.randint(96, 160)) for _ in range(640 * 480)))
+    card = None
+    for i in range(count):
+        frame = noise.copy()
+        if i % 20 == 0:
+            qrpath = os.path.join(directory, 'qr.png')
+            encoder.write('spotify:track:{0:022d}'.format(i), qrpath)
+            card = Image.open(qrpath).convert('L')
+            card = card.resize((card.size[0] * 2, card.size[1] * 2))
+        if i % 20 < 10:
+            frame.paste(card, (220 + 4 * (i % 20), 120 + 2 * (i % 20)))
+        frame.save(os.path.join(directory, 'frame-{0:05d}.png'.format(i)))
+    os.remove(os.path.join(directory, 'qr.png'))
+
+
+def run(directory, size):
+    source = framesource.ImageDirectorySource(directory, size, args.roi, loops=args.loops)
+    codes = set(code for (code, _) in source.codes())
+    print('{0:<10} {1}, {2} distinct'.format('{0}x{1}'.format(*size), source.stats.summary(), len(codes)))
+
+
+frames_dir = args.frames or tempfile.mkdtemp()
+try:
+    if not args.frames:
+        synthetic_frames(frames_dir, args.count)
+        print('{0} synthetic frames ({1} cards)'.format(args.count, (args.count + 19) // 20))
+    for size in args.sizes.split(','):
+        try:
+            run(frames_dir, parse_size(size))
+        except ValueError as e:
+            print('Unable to decode ({0})'.format(e))
+            break
+finally:
+    if not args.frames:
+        shutil.rmtree(frames_dir)
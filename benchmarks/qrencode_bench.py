@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Compares generating QR codes by launching `qrencode` once per card against the in-process
+# encoder, for a synthetic deck that mixes command cards (which repeat) with unique track cards.
+#
+#   % python benchmarks/qrencode_bench.py --cards 1000
+#
+
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import qrencoder
+
+arg_parser = argparse.ArgumentParser(description='Benchmarks the `qrencode` and builtin QR encoder backends.')
+arg_parser.add_argument('--cards', type=int, default=1000, help='the number of cards in the synthetic deck')
+args = arg_parser.parse_args()
+
+
+def synthetic_deck(count):
+    commands = ['cmd:playpause', 'cmd:next', 'cmd:turntable', 'cmd:livingroom', 'cmd:diningandkitchen',
+                'cmd:songonly', 'cmd:wholealbum', 'cmd:buildqueue', 'cmd:whatsong', 'cmd:whatnext']
+    deck = []
+    for i in range(count):
+        if i % 10 == 0:
+            deck.append(commands[(i // 10) % len(commands)])
+        elif i % 2 == 0:
+            deck.append('spotify:track:' + hashlib.md5(str(i)).hexdigest()[:22])
+        else:
+            deck.append('lib:' + hashlib.md5(str(i)).hexdigest())
+    return deck
+
+
+def run(backend, deck, outdir):
+    # Start from an empty on-disk cache each time so that only the in-memory memoization applies
+    encoder = qrencoder.QREncoder(backend)
+    start = time.time()
+    for (index, uri) in enumerate(deck):
+        encoder.write(uri, os.path.join(outdir, '{0}qr.png'.format(index)))
+    elapsed = time.time() - start
+    print('{0:<10} {1:8.3f}s total {2:8.3f}ms/card {3:6.3f} forks/card'.format(
+        backend, elapsed, elapsed * 1000 / len(deck), float(encoder.forks) / len(deck)))
+
+
+deck = synthetic_deck(args.cards)
+outdir = tempfile.mkdtemp()
+try:
+    print('{0} cards ({1} unique payloads)'.format(len(deck), len(set(deck))))
+    for backend in ['qrencode', 'builtin']:
+        try:
+            run(backend, deck, outdir)
+        except (OSError, ValueError) as e:
+            print('{0:<10} unavailable ({1})'.format(backend, e))
+finally:
+    shutil.rmtree(outdir)
@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+# Local stand-ins for `node-sonos-http-api` and the Spotify Web API, used by `bench.py` so that
+# `qrgen` and `qrplay` can be exercised without a Sonos system, a Spotify account, or network
+# access.  Both stubs can inject latency and errors, and record how long each request took.
+
+import BaseHTTPServer
+import base64
+import json
+import random
+import SocketServer
+import threading
+import time
+import urllib
+from urlparse import urlparse, parse_qs
+
+# A 1x1 PNG served as the artwork for every album
+ARTWORK = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==')
+
+# The number of tracks on each synthetic album (tracks on the same album share artwork)
+TRACKS_PER_ALBUM = 10
+
+COMMANDS = ['cmd:playpause', 'cmd:next', 'cmd:turntable', 'cmd:livingroom', 'cmd:diningandkitchen',
+            'cmd:songonly', 'cmd:wholealbum', 'cmd:buildqueue', 'cmd:whatsong', 'cmd:whatnext']
+
+
+def library_uri(n):
+    return 'lib:{0:032x}'.format(n)
+
+
+def spotify_uri(n):
+    return 'spotify:track:{0:022d}'.format(n)
+
+
+# Return a synthetic deck of `count` track URIs, alternating between library and Spotify tracks.
+def synthetic_deck(count):
+    return [library_uri(n) if n % 2 == 0 else spotify_uri(n) for n in range(count)]
+
+
+# Return a synthetic sequence of `count` scanned codes, mixing tracks with command cards.
+def synthetic_scans(count):
+    scans = []
+    for n in range(count):
+        if n % 5 == 4:
+            scans.append(COMMANDS[(n // 5) % len(COMMANDS)])
+        elif n % 2 == 0:
+            scans.append(library_uri(n))
+        else:
+            scans.append(spotify_uri(n))
+    return scans
+
+
+# Latency/error injection settings shared by the stub servers.
+class StubConfig(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive, and send each response in one piece (rather than one write per
+    # header, which interacts badly with Nagle's algorithm on persistent connections)
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start = time.time()
+        config = self.server.config
+        delay = config.latency + random.uniform(-config.jitter, config.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < config.error_rate:
+            (status, content_type, body) = (500, 'application/json', '{"status":"error"}')
+        else:
+            (status, content_type, body) = self.respond(urlparse(self.path))
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        with self.server.lock:
+            self.server.requests.append((self.path, time.time() - start))
+
+    def base_url(self):
+        return 'http://{0}:{1}'.format(*self.server.server_address)
+
+
+# Stands in for `node-sonos-http-api`: library metadata and listing, artwork, and a successful
+# response for every room/global action.
+class BridgeHandler(StubHandler):
+    def respond(self, url):
+        path = urllib.unquote(url.path)
+        if path.startswith('/art/'):
+            return (200, 'image/png', ARTWORK)
+        if path.startswith('/musicsearch/library/metadata/lib:'):
+            n = int(path.split(':')[-1], 16)
+            return (200, 'application/json', json.dumps(self.library_track(n)))
+        if path == '/musicsearch/library/listall':
+            tracks = []
+            for n in range(0, self.server.library_size * 2, 2):
+                track = self.library_track(n)
+                track['hash'] = library_uri(n)[4:]
+                tracks.append(track)
+            return (200, 'application/json', json.dumps({'tracks': tracks}))
+        return (200, 'application/json', '{"status":"success"}')
+
+    def library_track(self, n):
+        album = n // TRACKS_PER_ALBUM
+        return {
+            'trackName': 'Library Track {0}'.format(n),
+            'artistName': 'Artist {0}'.format(album % 50),
+            'albumName': 'Album {0}'.format(album),
+            'artworkUrl': '{0}/art/{1}.png'.format(self.base_url(), album),
+            'uri': 'x-file-cifs://nas/Music/Artist%20{0}/Album%20{1}/Track%20{2}.mp3'.format(album % 50, album, n)
+        }
+
+
+# Stands in for the Spotify Web API `tracks` endpoints (serve it at `/v1/`).
+class SpotifyHandler(StubHandler):
+    def respond(self, url):
+        if url.path == '/v1/tracks/' or url.path == '/v1/tracks':
+            ids = parse_qs(url.query).get('ids', [''])[0].split(',')
+            return (200, 'application/json', json.dumps({'tracks': [self.track(track_id) for track_id in ids]}))
+        if url.path.startswith('/v1/tracks/'):
+            return (200, 'application/json', json.dumps(self.track(url.path.split('/')[-1])))
+        return (404, 'application/json', '{"error":{"status":404}}')
+
+    def track(self, track_id):
+        n = int(track_id.split(':')[-1])
+        album = n // TRACKS_PER_ALBUM
+        return {
+            'name': 'Spotify Track {0}'.format(n),
+            'artists': [{'name': 'Artist {0}'.format(album % 50)}],
+            'album': {
+                'name': 'Album {0}'.format(album),
+                'images': [{'url': '{0}/art/{1}.png'.format(self.server.artwork_base_url, album), 'width': 640, 'height': 640}]
+            }
+        }
+
+
+# Start a stub server on a background thread and return it (`server.server_address` has the
+# port, and `server.requests` collects a (path, seconds) tuple for each request served).
+def start_server(handler_class, config, port=0, **attributes):
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler_class)
+    server.config = config
+    server.requests = []
+    server.lock = threading.Lock()
+    for (name, value) in attributes.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,197 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import re
+
+# Pillow is optional; without it cards can still be rendered with `webkit2png`
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+# Fonts to try (in order) for the card labels; `cards.css` asks for Helvetica, which usually isn't
+# available on Linux
+REGULAR_FONTS = ['Helvetica.ttc', '/System/Library/Fonts/Helvetica.ttc', 'Arial.ttf', 'DejaVuSans.ttf',
+                 '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 'LiberationSans-Regular.ttf',
+                 '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf']
+BOLD_FONTS = ['Helvetica-Bold.ttf', 'Arial Bold.ttf', 'Arial-Bold.ttf', 'DejaVuSans-Bold.ttf',
+              '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf', 'LiberationSans-Bold.ttf',
+              '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf']
+
+# CSS line height for `line-height: normal` is roughly this multiple of the font size
+LINE_HEIGHT = 1.2
+
+
+# Return the pixel size of a font (the fallback bitmap font doesn't know its own size).
+def font_size(font):
+    return getattr(font, 'size', 11)
+
+
+# Parse the (very simple) rules in `cards.css` into a map of selector -> {property: value}.
+def parse_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    rules = {}
+    for (selectors, body) in re.findall(r'([^{}]+)\{([^}]*)\}', css):
+        props = {}
+        for decl in body.split(';'):
+            if ':' in decl:
+                (name, value) = decl.split(':', 1)
+                props[name.strip()] = value.strip()
+        for selector in selectors.split(','):
+            rules.setdefault(selector.strip(), {}).update(props)
+    return rules
+
+
+# Convert a CSS length (`px` or `pt`) to CSS pixels.
+def css_px(value):
+    if value.endswith('pt'):
+        return float(value[:-2]) * 4 / 3
+    if value.endswith('px'):
+        return float(value[:-2])
+    return float(value)
+
+
+# The positions and sizes of the elements on a single card, read from `cards.css` so that the
+# stylesheet remains the one place where card dimensions are defined.  All values are in CSS
+# pixels.
+class CardLayout(object):
+    def __init__(self, css_path):
+        with open(css_path) as f:
+            rules = parse_css(f.read())
+
+        card = rules['.singlecard']
+        self.width = css_px(card['width'])
+        self.height = css_px(card['height'])
+
+        # The artwork and QR code are floated next to each other along the top of the card...
+        art = rules['.art']
+        self.art_box = (0, 0, css_px(art['width']), css_px(art['height']))
+        qrcode = rules['.qrcode']
+        self.qrcode_box = (self.art_box[2], 0, css_px(qrcode['width']), css_px(qrcode['height']))
+
+        # ...and the labels wrap underneath them
+        labels = rules['.labels']
+        self.labels_box = (css_px(labels['margin-left']),
+                           max(self.art_box[3], self.qrcode_box[3]) + css_px(labels['margin-top']),
+                           css_px(labels['width']), 0)
+
+        p = rules['p']
+        self.label_margin = css_px(p['margin'].split()[0])
+        self.label_font_size = css_px(p['font-size'])
+        self.song_margin = css_px(rules['.song']['margin-top'])
+        self.song_font_size = css_px(rules['.song']['font-size'])
+        self.small_font_size = css_px(rules['.small']['font-size'])
+        self.small_color = rules['.small']['color']
+
+
+# Renders card images directly with Pillow, mirroring the layout that `cards.css` produces in a
+# browser.  A renderer can be shared between threads.
+class CardRenderer(object):
+    def __init__(self, layout, scale=2.0):
+        if not Image:
+            raise ValueError('The native card renderer requires the `Pillow` package (`pip install Pillow`)')
+        self.layout = layout
+        self.scale = scale
+        self.fonts = {}
+
+    def font(self, size, bold=False):
+        key = (int(round(size * self.scale)), bold)
+        if key not in self.fonts:
+            font = None
+            for name in (BOLD_FONTS if bold else REGULAR_FONTS):
+                try:
+                    font = ImageFont.truetype(name, key[0])
+                    break
+                except IOError:
+                    pass
+            self.fonts[key] = font or ImageFont.load_default()
+        return self.fonts[key]
+
+    def box(self, box):
+        return tuple(int(round(v * self.scale)) for v in box)
+
+    # Render a card to a PNG file.
+    def render(self, path, artpath, qrpath, song, artist, album):
+        layout = self.layout
+        card = Image.new('RGB', (int(layout.width * self.scale), int(layout.height * self.scale)), 'white')
+
+        # Scale any artwork to fit its box (`object-fit: contain; object-position: center top`)
+        if artpath:
+            (x, y, w, h) = self.box(layout.art_box)
+            art = Image.open(artpath).convert('RGBA')
+            ratio = min(float(w) / art.size[0], float(h) / art.size[1])
+            art = art.resize((max(1, int(art.size[0] * ratio)), max(1, int(art.size[1] * ratio))), Image.ANTIALIAS)
+            card.paste(art, (x + (w - art.size[0]) // 2, y), art)
+
+        # Keep the QR code modules crisp
+        (x, y, w, h) = self.box(layout.qrcode_box)
+        qrcode = Image.open(qrpath).convert('RGB').resize((w, h), Image.NEAREST)
+        card.paste(qrcode, (x, y))
+
+        # Then the labels, each of which is a centered paragraph
+        draw = ImageDraw.Draw(card)
+        (x, y, w, h) = layout.labels_box
+        y += layout.song_margin
+        y = self.draw_paragraph(draw, x, y, w, [(song, self.font(layout.song_font_size, bold=True), 'black')])
+        for (prefix, text) in [('by', artist), ('from', album)]:
+            if text:
+                y += layout.label_margin
+                y = self.draw_paragraph(draw, x, y, w, [(prefix, self.font(layout.small_font_size), layout.small_color),
+                                                        (text, self.font(layout.label_font_size), 'black')])
+
+        card.save(path)
+
+    # Word-wrap and draw a paragraph made up of (text, font, color) runs, centered within the given
+    # width.  Returns the y position (in CSS pixels) of the bottom of the paragraph.
+    def draw_paragraph(self, draw, x, y, width, runs):
+        # Split the runs into words, then greedily fill each line
+        words = []
+        for (text, font, color) in runs:
+            if isinstance(text, str):
+                text = text.decode('utf-8')
+            for word in text.split():
+                words.append((word, font, color))
+
+        space = draw.textsize(u' ', font=words[0][1])[0] if words else 0
+        max_width = width * self.scale
+        lines = [[]]
+        line_width = 0
+        for word in words:
+            word_width = draw.textsize(word[0], font=word[1])[0]
+            if lines[-1] and line_width + space + word_width > max_width:
+                lines.append([])
+                line_width = 0
+            line_width += (space if lines[-1] else 0) + word_width
+            lines[-1].append((word, word_width))
+
+        top = y * self.scale
+        for line in lines:
+            line_height = max([font_size(word[1]) for (word, _) in line] or [0]) * LINE_HEIGHT
+            total_width = sum(word_width for (word, word_width) in line) + space * (len(line) - 1)
+            left = x * self.scale + (max_width - total_width) / 2
+            for ((text, font, color), word_width) in line:
+                # Align the runs along a common baseline
+                draw.text((left, top + line_height - font_size(font) * LINE_HEIGHT), text, font=font, fill=color)
+                left += word_width + space
+            top += line_height
+
+        return top / self.scale
@@ -0,0 +1,278 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import os
+import subprocess
+import time
+
+from latency import monotonic
+
+# Pillow is optional; it's only needed to replay a directory of images
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# In-process decoding uses either `pyzbar` or the `zbar` Python bindings (e.g. Raspbian's
+# `python-zbar` package), whichever is available
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+try:
+    import zbar
+except ImportError:
+    zbar = None
+
+ZBARCAM_PATH = '/usr/bin/zbarcam'
+FFMPEG_PATH = 'ffmpeg'
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.pgm', '.ppm')
+
+
+# Parse a `WIDTHxHEIGHT` size argument.
+def parse_size(value):
+    try:
+        (width, height) = [int(n) for n in value.lower().split('x')]
+    except ValueError:
+        raise ValueError('Expected a size like 300x200, got: ' + value)
+    return (width, height)
+
+
+# Parse an `X,Y,WIDTH,HEIGHT` region of interest argument, given as fractions of the frame (e.g.
+# `0.25,0.25,0.5,0.5` for the middle of the frame).
+def parse_roi(value):
+    try:
+        roi = tuple(float(n) for n in value.split(','))
+    except ValueError:
+        roi = ()
+    if len(roi) != 4 or min(roi) < 0 or roi[0] + roi[2] > 1 or roi[1] + roi[3] > 1 or not (roi[2] and roi[3]):
+        raise ValueError('Expected a region like 0.25,0.25,0.5,0.5 (fractions of the frame), got: ' + value)
+    return roi
+
+
+# Return the data of a QR code from a line of `zbarcam` output (`QR-Code:<data>`), or `None` if the
+# line is for some other kind of symbol.
+def parse_zbar_line(line):
+    (symbology, separator, data) = line.rstrip('\r\n').partition(':')
+    if not separator or symbology != 'QR-Code' or not data:
+        return None
+    return data
+
+
+class SourceStats(object):
+    def __init__(self):
+        self.started = monotonic()
+        self.frames = 0
+        self.decodes = 0
+        self.decode_time = 0.0
+        self.codes = 0
+
+    def elapsed(self):
+        return monotonic() - self.started
+
+    def summary(self):
+        elapsed = self.elapsed()
+        if not self.decodes:
+            return '{0} codes in {1:.1f}s'.format(self.codes, elapsed)
+        return '{0} frames, {1} decoded ({2:.1f}/s; {3:.1f}/s of decoder time), {4} codes in {5:.1f}s'.format(
+            self.frames, self.decodes, self.decodes / elapsed if elapsed else 0,
+            self.decodes / self.decode_time if self.decode_time else 0, self.codes, elapsed)
+
+
+# Reads QR codes from a `zbarcam` process, which captures and decodes the frames itself.  Only the
+# QR code decoder is enabled, since zbar otherwise tries every barcode type on every frame.
+class ZbarcamSource(object):
+    def __init__(self, device=None, size=None):
+        command = [ZBARCAM_PATH, '-Sdisable', '-Sqrcode.enable']
+        if size:
+            command.append('--prescale={0}x{1}'.format(*size))
+        if device:
+            command.append(device)
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        self.stats = SourceStats()
+
+    # Yield each (code, scan time) as it's decoded, until the scanner exits.
+    def codes(self):
+        # (`readline` rather than iterating over the file, which reads ahead in large blocks)
+        for line in iter(self.process.stdout.readline, ''):
+            scanned_at = monotonic()
+            code = parse_zbar_line(line)
+            if code:
+                self.stats.codes += 1
+                yield (code, scanned_at)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+
+# The base class for sources that decode frames in-process.  Subclasses define a `frames()`
+# generator that yields the frames as 8-bit grayscale (pixels, width, height) tuples.  Frames are
+# delivered at most `frame_rate` times per second (if nonzero), and decoded at most `max_rate` times
+# per second (frames in between are skipped).  Like `zbarcam`, a code is only reported when it comes
+# into view, not again for every frame in which it stays visible.
+class DecodingSource(object):
+    def __init__(self, frame_rate=0, max_rate=0):
+        if not pyzbar and not zbar:
+            raise ValueError('In-process decoding requires the `pyzbar` package (`pip install pyzbar`) or the `zbar` Python bindings')
+        self.frame_rate = frame_rate
+        self.max_rate = max_rate
+        self.closed = False
+        self.stats = SourceStats()
+        if not pyzbar:
+            self.scanner = zbar.ImageScanner()
+            self.scanner.parse_config('disable')
+            self.scanner.parse_config('qrcode.enable')
+
+    def decode(self, pixels, width, height):
+        if pyzbar:
+            return [symbol.data for symbol in pyzbar.decode((pixels, width, height), symbols=[pyzbar.ZBarSymbol.QRCODE])]
+        image = zbar.Image(width, height, 'Y800', pixels)
+        self.scanner.scan(image)
+        return [symbol.data for symbol in image]
+
+    def codes(self):
+        visible = set()
+        next_frame = next_decode = monotonic()
+        for (pixels, width, height) in self.frames():
+            if self.closed:
+                break
+            if self.frame_rate:
+                # Replay at the given rate (without drifting, however long decoding takes)
+                delay = next_frame - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_frame += 1.0 / self.frame_rate
+            self.stats.frames += 1
+
+            now = monotonic()
+            if self.max_rate:
+                if now < next_decode:
+                    continue
+                next_decode = now + 1.0 / self.max_rate
+            codes = self.decode(pixels, width, height)
+            self.stats.decodes += 1
+            self.stats.decode_time += monotonic() - now
+
+            for code in codes:
+                if code not in visible:
+                    self.stats.codes += 1
+                    yield (code, now)
+            visible = set(codes)
+
+    def close(self):
+        self.closed = True
+
+
+# Decodes raw frames from `ffmpeg`, which captures them from a camera (a `/dev/video*` device) or
+# reads them from a video file, and does the scaling, cropping to the region of interest, and
+# grayscale conversion.  When decoding is throttled, `ffmpeg` drops the extra frames itself.
+class FfmpegSource(DecodingSource):
+    def __init__(self, input, size, roi=None, frame_rate=0, max_rate=0):
+        # (Unless the frames are replayed at a given rate, `ffmpeg` does all of the throttling)
+        DecodingSource.__init__(self, frame_rate, max_rate if frame_rate else 0)
+        self.size = size
+
+        filters = []
+        rate = frame_rate or max_rate
+        if rate:
+            filters.append('fps={0}'.format(rate))
+        if roi:
+            filters.append('crop=iw*{2}:ih*{3}:iw*{0}:ih*{1}'.format(*roi))
+        filters.append('scale={0}:{1}'.format(*size))
+
+        command = [FFMPEG_PATH, '-loglevel', 'error']
+        if input.startswith('/dev/'):
+            command += ['-f', 'v4l2']
+        command += ['-i', input, '-vf', ','.join(filters), '-f', 'rawvideo', '-pix_fmt', 'gray', '-']
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    def frames(self):
+        (width, height) = self.size
+        frame_size = width * height
+        while True:
+            pixels = self.process.stdout.read(frame_size)
+            if len(pixels) < frame_size:
+                break
+            yield (pixels, width, height)
+
+    def close(self):
+        DecodingSource.close(self)
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+
+
+# Replays a directory of recorded images (in filename order), `loops` times over.
+class ImageDirectorySource(DecodingSource):
+    def __init__(self, directory, size=None, roi=None, frame_rate=0, max_rate=0, loops=1):
+        DecodingSource.__init__(self, frame_rate, max_rate)
+        if not Image:
+            raise ValueError('Replaying images requires the `Pillow` package (`pip install Pillow`)')
+        self.paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                      if name.lower().endswith(IMAGE_EXTENSIONS)]
+        if not self.paths:
+            raise ValueError('No images found in ' + directory)
+        self.size = size
+        self.roi = roi
+        self.loops = loops
+        # Frames are prepared on the first pass and kept for the rest, so that later passes only
+        # measure decoding
+        self.cache = {} if loops > 1 else None
+
+    def load_frame(self, path):
+        image = Image.open(path).convert('L')
+        if self.roi:
+            (x, y, w, h) = self.roi
+            (width, height) = image.size
+            image = image.crop((int(x * width), int(y * height), int((x + w) * width), int((y + h) * height)))
+        if self.size:
+            image = image.resize(self.size, Image.BILINEAR)
+        return (image.tobytes(), image.size[0], image.size[1])
+
+    def frames(self):
+        for _ in range(self.loops):
+            for path in self.paths:
+                if self.cache is None:
+                    yield self.load_frame(path)
+                    continue
+                if path not in self.cache:
+                    self.cache[path] = self.load_frame(path)
+                yield self.cache[path]
+
+
+# Open the frame source of the given kind: `zbarcam`, `ffmpeg` (in-process decoding of frames
+# captured from the camera by ffmpeg), or `replay` (in-process decoding of the images in a
+# directory, or the frames of a video file).
+def open_source(kind, device=None, replay=None, size=None, roi=None, max_rate=0, replay_fps=0):
+    if kind == 'zbarcam':
+        return ZbarcamSource(device, size)
+    elif kind == 'ffmpeg':
+        return FfmpegSource(device or '/dev/video0', size or (640, 480), roi, 0, max_rate)
+    elif kind == 'replay':
+        if os.path.isdir(replay):
+            return ImageDirectorySource(replay, size, roi, replay_fps, max_rate)
+        return FfmpegSource(replay, size or (640, 480), roi, replay_fps, max_rate)
+    raise ValueError('Unknown frame source: ' + kind)
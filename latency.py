@@ -0,0 +1,208 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import BaseHTTPServer
+import ctypes
+import ctypes.util
+import json
+import random
+import sys
+import threading
+import time
+
+
+# Return the current time in seconds from a clock that never goes backwards (unlike `time.time()`,
+# which jumps whenever the clock is set, e.g. by NTP shortly after a Raspberry Pi boots).  Python 2
+# has no `time.monotonic()`, so on Linux `clock_gettime()` is called directly.
+def _wall_clock():
+    return time.time()
+
+monotonic = getattr(time, 'monotonic', None)
+if monotonic is None and sys.platform.startswith('linux'):
+    try:
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                return _wall_clock()
+            return t.tv_sec + t.tv_nsec * 1e-9
+    except (OSError, AttributeError, TypeError):
+        monotonic = None
+if monotonic is None:
+    monotonic = _wall_clock
+
+
+# The (Prometheus default) upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for (i, bound) in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))]
+
+
+def format_latencies(samples):
+    return 'p50 {0:7.1f}ms  p90 {1:7.1f}ms  p99 {2:7.1f}ms  max {3:7.1f}ms'.format(
+        *[percentile(samples, p) * 1000 for p in [50, 90, 99, 100]])
+
+
+# Collects latency observations into histograms, one per metric and set of label values (e.g. one
+# per command type and room), and optionally appends each observation to a JSON-lines trace file.
+# Observations of the metrics passed to `keep_samples` are also sampled (per metric, whatever the
+# labels), so that percentiles can be reported at the end of a run.
+class LatencyRecorder(object):
+    def __init__(self, prefix, trace_path=None):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # {name: (help, {sorted label items: Histogram})}
+        self.metrics = {}
+        self.trace_file = open(trace_path, 'a') if trace_path else None
+        # {name: [seconds]} and {name: number of observations}
+        self.samples = {}
+        self.sample_counts = {}
+        self.max_samples = 0
+
+    def define(self, name, help):
+        self.metrics[name] = (help, {})
+
+    # Sample the observations of the given metrics.  Up to `max_samples` are kept per metric; beyond
+    # that, a uniform random sample of all of the observations is kept (so that memory use stays
+    # bounded however long the run is).
+    def keep_samples(self, names, max_samples=100000):
+        with self.lock:
+            self.max_samples = max_samples
+            for name in names:
+                self.samples.setdefault(name, [])
+                self.sample_counts.setdefault(name, 0)
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histograms = self.metrics[name][1]
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(seconds)
+            samples = self.samples.get(name)
+            if samples is not None:
+                self.sample_counts[name] += 1
+                if len(samples) < self.max_samples:
+                    samples.append(seconds)
+                else:
+                    i = random.randrange(self.sample_counts[name])
+                    if i < self.max_samples:
+                        samples[i] = seconds
+
+            if self.trace_file:
+                record = dict(labels)
+                record.update({'time': time.time(), 'metric': name, 'seconds': round(seconds, 6)})
+                self.trace_file.write(json.dumps(record, sort_keys=True) + '\n')
+                self.trace_file.flush()
+
+    # Record the time elapsed since `start` (a `monotonic()` timestamp).
+    def observe_since(self, name, start, **labels):
+        self.observe(name, monotonic() - start, **labels)
+
+    # Return all of the histograms in the Prometheus text exposition format.
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics):
+                (help, histograms) = self.metrics[name]
+                metric = self.prefix + name
+                lines.append('# HELP {0} {1}'.format(metric, help))
+                lines.append('# TYPE {0} histogram'.format(metric))
+                for key in sorted(histograms):
+                    histogram = histograms[key]
+                    cumulative = 0
+                    for (bound, count) in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append('{0}_bucket{1} {2}'.format(metric, format_labels(key + (('le', repr(float(bound))),)), cumulative))
+                    lines.append('{0}_bucket{1} {2}'.format(metric, format_labels(key + (('le', '+Inf'),)), histogram.count))
+                    lines.append('{0}_sum{1} {2!r}'.format(metric, format_labels(key), histogram.sum))
+                    lines.append('{0}_count{1} {2}'.format(metric, format_labels(key), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.trace_file:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+def format_labels(items):
+    if not items:
+        return ''
+    def escape(value):
+        return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return u'{' + u','.join(u'{0}="{1}"'.format(name, escape(value)) for (name, value) in items) + u'}'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.recorder.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve the recorder's histograms at `http://<host>:<port>/metrics` on a background thread.  (Only
+# local clients can connect by default; pass `host=''` to listen on all interfaces.)
+def serve_metrics(recorder, port, host='127.0.0.1'):
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    server.recorder = recorder
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,102 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import os
+import threading
+import time
+
+# The onboard green LED of a Raspberry Pi 3 Model B (your mileage may vary with other models)
+DEFAULT_LED_PATH = '/sys/class/leds/led0'
+
+# Each pattern is a list of (brightness, seconds) steps, and always ends with the LED off
+PATTERNS = {
+    # Two short blinks: the code was handled
+    'success': [(1, 0.15), (0, 0.15), (1, 0.15), (0, 0)],
+    # One long blink: the code isn't one that qrocodile knows about
+    'unknown': [(1, 0.6), (0, 0)],
+    # Five rapid blinks: the bridge couldn't be reached or returned an error
+    'error': [(1, 0.05), (0, 0.05)] * 4 + [(1, 0.05), (0, 0)]
+}
+
+
+# Plays blink patterns on an LED without blocking the caller.  The LED's `brightness` file is kept
+# open (and its `trigger` is set once, so that the kernel leaves the LED alone), and the patterns
+# are played on a background thread.  A new pattern replaces whatever is still playing.  `path` is
+# the LED's sysfs directory, but any directory will do (e.g. for testing, where the files are just
+# created).
+class LedFeedback(object):
+    def __init__(self, path=DEFAULT_LED_PATH):
+        self.condition = threading.Condition()
+        self.steps = []
+        self.closed = False
+        try:
+            with open(os.path.join(path, 'trigger'), 'w') as trigger_file:
+                trigger_file.write('none')
+            self.brightness_file = open(os.path.join(path, 'brightness'), 'w')
+        except IOError as e:
+            print('LED feedback is disabled ({0})'.format(e))
+            self.brightness_file = None
+            return
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def play(self, pattern):
+        if not self.brightness_file:
+            return
+        with self.condition:
+            self.steps = list(PATTERNS[pattern])
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.steps and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                (brightness, duration) = self.steps.pop(0)
+            self.set_brightness(brightness)
+            if duration:
+                time.sleep(duration)
+
+    def set_brightness(self, brightness):
+        try:
+            self.brightness_file.seek(0)
+            self.brightness_file.write(str(brightness))
+            self.brightness_file.flush()
+        except IOError as e:
+            print('Failed to set LED brightness ({0})'.format(e))
+
+    # Stop playing, and leave the LED off.
+    def close(self):
+        if not self.brightness_file:
+            return
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.set_brightness(0)
+        self.brightness_file.close()
+        self.brightness_file = None
@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import json
+import sqlite3
+
+# The size of each chunk read from the server while parsing the track list
+CHUNK_SIZE = 64 * 1024
+
+
+# Incrementally parse the objects in the array stored under `key` in a (potentially very large)
+# JSON document, reading from `f` in chunks so that the whole document never needs to be in memory.
+def iter_json_array(f, key):
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+
+    def more():
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError('Unexpected end of JSON data')
+        return chunk
+
+    # Find the start of the array
+    marker = '"{0}"'.format(key)
+    while True:
+        index = buf.find(marker)
+        if index >= 0:
+            index = buf.find('[', index)
+        if index >= 0:
+            pos = index + 1
+            break
+        buf += more()
+
+    while True:
+        # Skip over whitespace and separators to the next value (or the end of the array)
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf):
+                break
+            buf = more()
+            pos = 0
+        if buf[pos] == ']':
+            return
+
+        # Decode the next value, reading more data if it's incomplete
+        while True:
+            try:
+                (value, end) = decoder.raw_decode(buf, pos)
+                break
+            except ValueError:
+                buf = buf[pos:] + more()
+                pos = 0
+        yield value
+        pos = end
+
+
+# Return the `lib:` URI for a track from the `listall` response.
+def track_uri(track):
+    track_hash = track.get('hash') or track.get('id')
+    if track_hash.startswith('lib:'):
+        return track_hash
+    return 'lib:' + track_hash
+
+
+# A persistent, searchable index of the tracks in the music library, built from the
+# `musicsearch/library/listall` endpoint of `node-sonos-http-api`.
+class LibraryIndex(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS tracks (uri TEXT PRIMARY KEY, artist TEXT, album TEXT, title TEXT, search TEXT, generation INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+
+    def info(self, key):
+        row = self.db.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_info(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (key, value))
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+
+    # Bring the index up to date with the track list at the given path, fetched using a
+    # `SonosClient`.  If the server supports conditional requests, nothing is downloaded when the
+    # library hasn't changed.  Returns true if the index was updated.
+    def refresh(self, client, path):
+        url = client.base_url() + path
+        headers = {}
+        if self.info('url') == url:
+            if self.info('etag'):
+                headers['If-None-Match'] = self.info('etag')
+            if self.info('last_modified'):
+                headers['If-Modified-Since'] = self.info('last_modified')
+
+        print(url)
+        response = client.open(path, headers=headers, ok_statuses=(200, 304))
+        if response.status == 304:
+            response.read()
+            client.finish(response)
+            return False
+
+        # Upsert every track in the response, then remove the ones that weren't seen (all in a
+        # single transaction, so an interrupted refresh leaves the previous index intact)
+        generation = int(self.info('generation') or 0) + 1
+        for track in iter_json_array(response, 'tracks'):
+            artist = track.get('artistName') or ''
+            album = track.get('albumName') or ''
+            title = track.get('trackName') or ''
+            search = u' '.join([artist, album, title]).lower()
+            self.db.execute('INSERT OR REPLACE INTO tracks (uri, artist, album, title, search, generation) VALUES (?, ?, ?, ?, ?, ?)',
+                            (track_uri(track), artist, album, title, search, generation))
+        self.db.execute('DELETE FROM tracks WHERE generation != ?', (generation,))
+
+        # Read the rest of the response so that the connection can be reused
+        response.read()
+        client.finish(response)
+
+        self.set_info('generation', str(generation))
+        self.set_info('url', url)
+        self.set_info('etag', response.getheader('ETag'))
+        self.set_info('last_modified', response.getheader('Last-Modified'))
+        self.db.commit()
+        return True
+
+    # Return the (uri, artist, album, title) of each track whose artist, album, and/or title
+    # contain all of the words in the query (all tracks for an empty query).
+    def search(self, query=''):
+        sql = 'SELECT uri, artist, album, title FROM tracks'
+        words = query.lower().split()
+        if words:
+            sql += ' WHERE ' + ' AND '.join(["search LIKE ? ESCAPE '\\'"] * len(words))
+        sql += ' ORDER BY artist, album, title'
+        params = ['%' + w.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for w in words]
+        return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import sqlite3
+import threading
+import time
+
+
+# A persistent cache of raw metadata responses (Spotify tracks, library track metadata) keyed by
+# URI.  Entries expire after `ttl` seconds, and once there are more than `max_entries` entries the
+# least recently used ones are evicted.  The cache stores the responses exactly as they were
+# returned by the server, so any post-processing (e.g. `strip_title_junk`) is applied fresh each
+# time an entry is used.
+class MetadataCache(object):
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # The cache is shared by all of the `qrgen` worker threads, hence the lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS metadata (uri TEXT PRIMARY KEY, response TEXT, fetched_at REAL, used_at REAL)')
+        self.db.commit()
+
+    # Return the cached response for the given URI, or `None` if there is no entry for it (or the
+    # entry has expired, unless `allow_expired` is true).
+    def get(self, uri, allow_expired=False):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT response, fetched_at FROM metadata WHERE uri = ?', (uri,)).fetchone()
+            if not row:
+                return None
+            (response, fetched_at) = row
+            if not allow_expired and now - fetched_at > self.ttl:
+                return None
+            self.db.execute('UPDATE metadata SET used_at = ? WHERE uri = ?', (now, uri))
+            return response
+
+    def put(self, uri, response):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO metadata (uri, response, fetched_at, used_at) VALUES (?, ?, ?, ?)', (uri, response, now, now))
+            self.db.commit()
+
+    # Evict the least recently used entries beyond `max_entries` and write everything to disk.
+    def close(self):
+        with self.lock:
+            self.db.execute('DELETE FROM metadata WHERE uri NOT IN (SELECT uri FROM metadata ORDER BY used_at DESC LIMIT ?)', (self.max_entries,))
+            self.db.commit()
+            self.db.close()
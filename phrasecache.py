@@ -0,0 +1,120 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import hashlib
+import os
+import Queue
+import shlex
+import subprocess
+import threading
+
+DEFAULT_TTS_COMMAND = 'pico2wave -w {path} {text}'
+
+
+# Keeps spoken phrases as pre-rendered audio clips in the bridge's clips directory (the
+# `static/clips` folder of `node-sonos-http-api`, which must be writable from here, e.g. over a
+# shared folder), so that they can be played with `/<room>/clip/<file>` instead of being synthesized
+# by the bridge each time.  The phrases that are known up front are rendered once (and kept across
+# runs); any other phrase is spoken the usual way the first time, rendered in the background, and
+# kept in a bounded LRU of `max_dynamic` clips.  Clips are rendered one at a time on a background
+# thread by running `tts_command` (with `{path}` and `{text}` replaced by the output path and the
+# phrase).
+class PhraseCache(object):
+    def __init__(self, clips_dir, tts_command=DEFAULT_TTS_COMMAND, max_dynamic=50):
+        self.clips_dir = clips_dir
+        self.tts_command = tts_command
+        self.max_dynamic = max_dynamic
+        self.lock = threading.Lock()
+        self.static_phrases = set()
+        # The rendered clips for phrases that aren't known up front, least recently used first
+        self.dynamic_clips = [name for (_, name) in sorted(
+            (os.path.getmtime(os.path.join(clips_dir, name)), name)
+            for name in os.listdir(clips_dir) if name.startswith('qroc-dyn-'))]
+        self.pending = set()
+        self.render_queue = Queue.Queue()
+
+        thread = threading.Thread(target=self.render_clips)
+        thread.daemon = True
+        thread.start()
+
+    def clip_name(self, phrase):
+        prefix = 'qroc-' if phrase in self.static_phrases else 'qroc-dyn-'
+        return prefix + hashlib.sha1(phrase).hexdigest()[:16] + '.wav'
+
+    # Render any of the given phrases that haven't been rendered already.
+    def prepare(self, phrases):
+        with self.lock:
+            self.static_phrases.update(phrases)
+        for phrase in phrases:
+            self.request_render(phrase)
+
+    # Return the name of the clip for the given phrase, or `None` if it hasn't been rendered yet (in
+    # which case it will be rendered in the background for next time).
+    def lookup(self, phrase):
+        name = self.clip_name(phrase)
+        path = os.path.join(self.clips_dir, name)
+        if not os.path.exists(path):
+            self.request_render(phrase)
+            return None
+        with self.lock:
+            if name in self.dynamic_clips:
+                self.dynamic_clips.remove(name)
+                self.dynamic_clips.append(name)
+                # (Touch the clip so that the order survives a restart)
+                os.utime(path, None)
+        return name
+
+    def request_render(self, phrase):
+        with self.lock:
+            if phrase in self.pending:
+                return
+            self.pending.add(phrase)
+        self.render_queue.put(phrase)
+
+    def render_clips(self):
+        while True:
+            phrase = self.render_queue.get()
+            try:
+                self.render(phrase)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print('Failed to render phrase \'{0}\' ({1})'.format(phrase, e))
+            with self.lock:
+                self.pending.discard(phrase)
+
+    def render(self, phrase):
+        name = self.clip_name(phrase)
+        path = os.path.join(self.clips_dir, name)
+        if os.path.exists(path):
+            return
+
+        # Render to a temporary file first so that the bridge never plays a partial clip
+        temp_path = os.path.join(self.clips_dir, 'tmp-' + name)
+        command = [arg.format(path=temp_path, text=phrase) for arg in shlex.split(self.tts_command)]
+        subprocess.check_call(command)
+        os.rename(temp_path, path)
+
+        with self.lock:
+            if name.startswith('qroc-dyn-'):
+                self.dynamic_clips.append(name)
+                while len(self.dynamic_clips) > self.max_dynamic:
+                    os.remove(os.path.join(self.clips_dir, self.dynamic_clips.pop(0)))
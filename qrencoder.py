@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import hashlib
+import os
+import struct
+import subprocess
+import threading
+import zlib
+
+# The `qrcode` package is optional; without it we fall back on the external `qrencode` tool
+try:
+    import qrcode
+except ImportError:
+    qrcode = None
+
+# These match the `qrencode` defaults (3 pixels per module, 4 module quiet zone, and the lowest
+# error correction level) so that both backends produce equivalent images
+MODULE_SIZE = 3
+MARGIN = 4
+
+
+# Encode a matrix of booleans (true for dark modules) as a 1-bit grayscale PNG, scaling each module
+# up to `MODULE_SIZE` pixels.
+def matrix_to_png(matrix):
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    size = len(matrix) * MODULE_SIZE
+    rows = []
+    for matrix_row in matrix:
+        # Pack the row into bits (a set bit is white)
+        bits = []
+        for dark in matrix_row:
+            bits.extend([0 if dark else 1] * MODULE_SIZE)
+        bits.extend([0] * (-len(bits) % 8))
+        packed = bytearray()
+        for i in range(0, len(bits), 8):
+            byte = 0
+            for bit in bits[i:i + 8]:
+                byte = (byte << 1) | bit
+            packed.append(byte)
+        # Each scanline starts with a filter type byte (0 = none)
+        rows.extend([b'\x00' + bytes(packed)] * MODULE_SIZE)
+
+    header = struct.pack('>IIBBBBB', size, size, 1, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(b''.join(rows), 9)) + chunk(b'IEND', b'')
+
+
+# Generates QR code PNG images, either in-process (using the `qrcode` package) or by running the
+# external `qrencode` tool.  The encoded module matrix and PNG data for each payload are memoized,
+# and if `cache_dir` is given the PNG data is also kept on disk between runs.
+class QREncoder(object):
+    def __init__(self, backend='auto', cache_dir=None):
+        if backend == 'auto':
+            backend = 'builtin' if qrcode else 'qrencode'
+        if backend == 'builtin' and not qrcode:
+            raise ValueError('The builtin QR encoder requires the `qrcode` package (`pip install qrcode`)')
+        self.backend = backend
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.matrices = {}
+        self.pngs = {}
+        self.lock = threading.Lock()
+
+        # The number of `qrencode` processes launched (useful for benchmarking)
+        self.forks = 0
+
+    # Return the QR code module matrix (including the quiet zone) for the given payload.
+    def matrix(self, payload):
+        with self.lock:
+            if payload in self.matrices:
+                return self.matrices[payload]
+
+        qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, border=MARGIN)
+        qr.add_data(payload)
+        qr.make(fit=True)
+        matrix = qr.get_matrix()
+
+        with self.lock:
+            self.matrices[payload] = matrix
+        return matrix
+
+    # Return the PNG data for the given payload.
+    def png(self, payload):
+        with self.lock:
+            if payload in self.pngs:
+                return self.pngs[payload]
+
+        cache_path = None
+        if self.cache_dir:
+            key = hashlib.sha1('{0}:{1}'.format(self.backend, payload)).hexdigest()
+            cache_path = os.path.join(self.cache_dir, key + '.png')
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+        else:
+            if self.backend == 'builtin':
+                data = matrix_to_png(self.matrix(payload))
+            else:
+                with self.lock:
+                    self.forks += 1
+                data = subprocess.check_output(['qrencode', '-o', '-', payload])
+            if cache_path:
+                temp_path = cache_path + '.tmp.{0}'.format(threading.current_thread().ident)
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.rename(temp_path, cache_path)
+
+        with self.lock:
+            self.pngs[payload] = data
+        return data
+
+    # Write the PNG image for the given payload to a file.
+    def write(self, payload, path):
+        with open(path, 'wb') as f:
+            f.write(self.png(payload))
@@ -21,16 +21,27 @@
 #
 
 import argparse
+from artcache import ArtworkCache, can_resize, resize_artwork
+import cardimage
+from contextlib import contextmanager
 import hashlib
 import json
+import math
+from metacache import MetadataCache
+from multiprocessing.pool import ThreadPool
 import os.path
+from libindex import LibraryIndex
+from qrencoder import QREncoder
+from sonosclient import SonosClient
+import sheets
 import shutil
 import spotipy
 import spotipy.util as util
 import subprocess
 import sys
+import threading
+import time
 import urllib
-import urllib2
 
 # Build a map of the known commands
 # TODO: Might be better to specify these in the input file to allow for more customization
@@ -48,17 +59,52 @@ commands = {
   'cmd:whatnext': ('What\'s Next?', 'https://raw.githubusercontent.com/google/material-design-icons/master/action/drawable-xxxhdpi/ic_help_outline_black_48dp.png')
 }
 
+# The artwork for room switching commands that don't have their own (see `--config`)
+ROOM_ICON_URL = 'https://raw.githubusercontent.com/google/material-design-icons/master/action/drawable-xxxhdpi/ic_home_black_48dp.png'
+
 # Parse the command line arguments
 arg_parser = argparse.ArgumentParser(description='Generates an HTML page containing cards with embedded QR codes that can be interpreted by `qrplay`.')
 arg_parser.add_argument('--input', help='the file containing the list of commands and songs to generate')
 arg_parser.add_argument('--generate-images', action='store_true', help='generate an individual PNG image for each card')
+arg_parser.add_argument('--renderer', choices=['auto', 'native', 'webkit2png'], default='auto', help='how card images are generated: in-process using Pillow (`native`), or by rendering HTML with `webkit2png` (`auto` prefers `native` when available)')
+arg_parser.add_argument('--card-scale', type=float, default=2.0, help='the number of image pixels per CSS pixel in generated card images')
+arg_parser.add_argument('--rebuild', action='store_true', help='regenerate every card, instead of only those that changed since the last run')
+arg_parser.add_argument('--cards-per-sheet', type=int, default=8, help='the number of cards in each of the generated HTML sheet files')
+arg_parser.add_argument('--art-dpi', type=float, default=300, help='scale artwork down to this print resolution (at the size it appears on the cards), or 0 to use it exactly as downloaded')
+arg_parser.add_argument('--art-quality', type=int, default=85, help='the JPEG quality used for resized artwork')
+arg_parser.add_argument('--pdf', action='store_true', help='also generate a print-ready PDF (`out/cards.pdf`) containing all of the cards (requires Pillow)')
+arg_parser.add_argument('--pdf-page', choices=sorted(sheets.PAGE_SIZES.keys()), default='letter', help='the page size used for the PDF')
+arg_parser.add_argument('--stats-file', help='write the timing of each card generation stage to this file (as JSON)')
+arg_parser.add_argument('--config', help='also generate cards for the room switching commands in this `qrplay` config file (see README)')
 arg_parser.add_argument('--list-library', action='store_true', help='list all available library tracks')
+arg_parser.add_argument('--search', help='list the library tracks whose artist, album, and/or title contain all of the given words')
 arg_parser.add_argument('--hostname', default='localhost', help='the hostname or IP address of the machine running `node-sonos-http-api`')
+arg_parser.add_argument('--port', type=int, default=5005, help='the port on which `node-sonos-http-api` is listening')
+arg_parser.add_argument('--timeout', type=float, default=10, help='the number of seconds to wait for a response from `node-sonos-http-api`')
+arg_parser.add_argument('--retries', type=int, default=2, help='the number of times to retry a failed request to `node-sonos-http-api`')
+arg_parser.add_argument('--jobs', type=int, default=1, help='the number of cards to process concurrently (most of the time is spent waiting on the network and external tools, so this can be much higher than the number of CPU cores)')
 arg_parser.add_argument('--spotify-username', help='the username used to set up Spotify access (only needed if you want to generate cards for Spotify tracks)')
+arg_parser.add_argument('--spotify-api-url', help='an alternate base URL for the Spotify Web API (e.g. a local stand-in used for benchmarking)')
+arg_parser.add_argument('--qr-backend', choices=['auto', 'builtin', 'qrencode'], default='auto', help='how QR codes are generated: in-process using the `qrcode` package (`builtin`), or using the external `qrencode` tool (`auto` prefers `builtin` when available)')
+arg_parser.add_argument('--cache-dir', default=os.path.join(os.path.expanduser('~'), '.qrocodile'), help='the directory used to cache track metadata between runs')
+arg_parser.add_argument('--metadata-ttl', type=float, default=30, help='the number of days before cached track metadata is fetched again')
+arg_parser.add_argument('--metadata-cache-size', type=int, default=50000, help='the maximum number of tracks kept in the metadata cache')
+arg_parser.add_argument('--refresh-metadata', action='store_true', help='ignore any cached track metadata and fetch it again')
+arg_parser.add_argument('--offline', action='store_true', help='use only cached track metadata (tracks that are not in the cache are skipped)')
 args = arg_parser.parse_args()
 print args
 
-base_url = 'http://' + args.hostname + ':5005'
+# Room switching commands defined in a `qrplay` config file are labeled with the room they switch to
+if args.config:
+    with open(args.config) as f:
+        rooms = json.load(f).get('rooms') or {}
+    for (uri, room) in rooms.items():
+        # (Labels are UTF-8 encoded, like the track labels)
+        (uri, room) = (uri.encode('utf-8'), room.encode('utf-8'))
+        commands[uri] = (room, commands[uri][1] if uri in commands else ROOM_ICON_URL)
+
+# All requests to the bridge share a pool of keep-alive connections
+client = SonosClient(args.hostname, args.port, timeout=args.timeout, retries=args.retries, max_idle=max(4, args.jobs))
 
 if args.spotify_username:
     # Set up Spotify access (comment this out if you don't want to generate cards for Spotify tracks)
@@ -66,6 +112,8 @@ if args.spotify_username:
     token = util.prompt_for_user_token(args.spotify_username, scope)
     if token:
         sp = spotipy.Spotify(auth=token)
+        if args.spotify_api_url:
+            sp.prefix = args.spotify_api_url
     else:
         raise ValueError('Can\'t get Spotify token for ' + username)
 else:
@@ -73,18 +121,143 @@ else:
     sp = None
 
 
-def perform_request(url):
-    print(url)
-    response = urllib2.urlopen(url)
-    result = response.read()
-    return result
-
-
-def list_library_tracks():
-    result_json = perform_request(base_url + '/musicsearch/library/listall')
-    tracks = json.loads(result_json)['tracks']
-    for t in tracks:
-        print(t)
+# Cache the raw metadata responses so that re-running an unchanged deck doesn't need the network
+if not os.path.exists(args.cache_dir):
+    os.makedirs(args.cache_dir)
+metadata_cache = MetadataCache(os.path.join(args.cache_dir, 'metadata.sqlite'), args.metadata_ttl * 24 * 60 * 60, args.metadata_cache_size)
+
+# Artwork is downloaded once per unique URL into the cache directory, then copied into `out/art`
+artwork_cache = ArtworkCache(os.path.join(args.cache_dir, 'artwork'), offline=args.offline)
+
+# One lock per downloaded image, so that cards sharing artwork wait for a single copy to be written
+# while different artwork is copied/resized concurrently
+output_art_locks = {}
+output_art_locks_lock = threading.Lock()
+
+# The card dimensions are defined once, in `cards.css`
+card_layout = cardimage.CardLayout('cards.css')
+if args.renderer == 'auto':
+    args.renderer = 'native' if cardimage.Image else 'webkit2png'
+card_renderer = cardimage.CardRenderer(card_layout, args.card_scale) if args.renderer == 'native' else None
+if args.pdf and not card_renderer:
+    raise ValueError('PDF output requires the native card renderer (`pip install Pillow`)')
+
+# Artwork is scaled down to the print resolution (or to the card image resolution, if that's higher)
+if args.art_dpi and not can_resize():
+    print('Artwork will be used as downloaded (resizing requires `pip install Pillow`)')
+    args.art_dpi = 0
+if args.art_dpi:
+    art_pixels = int(math.ceil(max(card_layout.art_box[2], card_layout.art_box[3]) * max(args.art_dpi / sheets.CSS_DPI, args.card_scale)))
+else:
+    art_pixels = 0
+
+# The size of each artwork file in the output directory, and of the download it was made from
+artwork_sizes = {}
+
+# QR code images are memoized by payload (and kept in the cache directory between runs)
+qr_encoder = QREncoder(args.qr_backend, os.path.join(args.cache_dir, 'qr'))
+
+
+# The maximum number of track IDs accepted by a single Spotify `tracks` request
+SPOTIFY_BATCH_SIZE = 50
+
+# Spotify track metadata fetched in bulk by `prefetch_spotify_tracks`, keyed by URI
+spotify_tracks = {}
+
+# The manifest from the previous run, its cards keyed by fingerprint, and a hash of `cards.css` (all
+# set up by `generate_cards`)
+previous_manifest = {'cards': {}, 'files': []}
+previous_cards = {}
+css_hash = None
+
+# The cards generated during this run, keyed by fingerprint, and a lock per fingerprint so that
+# identical cards are only generated once
+generated_cards = {}
+card_locks = {}
+card_locks_lock = threading.Lock()
+
+# Accumulated wall-clock time spent in each card generation stage (summed across all workers), and
+# the individual timings that make up each total
+stage_times = {}
+stage_samples = {}
+stage_times_lock = threading.Lock()
+
+
+# Record the time spent in the enclosed block under the given stage name.
+@contextmanager
+def timed_stage(stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        with stage_times_lock:
+            stage_times[stage] = stage_times.get(stage, 0.0) + elapsed
+            stage_samples.setdefault(stage, []).append(elapsed)
+
+
+# Print the total size of the artwork on each sheet, compared to the artwork as downloaded.  (Each
+# image is counted once per sheet, since a browser only loads it once.)
+def print_sheet_sizes(sheet_art):
+    print('Artwork per sheet (as downloaded -> in output):')
+    for name in sorted(sheet_art.keys()):
+        original = sum(original for (original, size) in sheet_art[name].values())
+        size = sum(size for (original, size) in sheet_art[name].values())
+        saved = 100.0 * (original - size) / original if original else 0
+        print('  {0}  {1:8.1f}KB -> {2:8.1f}KB  ({3:.0f}% smaller)'.format(name, original / 1024.0, size / 1024.0, saved))
+
+
+# Print the time spent in each stage.  (With more than one job, each stage's time is summed across
+# the workers, so it can add up to more than the run took.)
+def print_stage_times(card_count, total_elapsed):
+    print('Generated {0} cards in {1:.2f}s using {2} job(s)'.format(card_count, total_elapsed, args.jobs))
+    summed = ' (summed over {0} jobs)'.format(args.jobs) if args.jobs > 1 else ''
+    for stage in ['metadata', 'qrencode', 'artwork', 'image']:
+        if stage in stage_times:
+            print('  {0:<10} {1:8.2f}s{2}'.format(stage, stage_times[stage], summed))
+
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            json.dump({'cards': card_count, 'jobs': args.jobs, 'elapsed': total_elapsed, 'stages': stage_samples}, f)
+
+
+def perform_request(path):
+    print(client.base_url() + path)
+    # (`qrgen` only ever reads from the bridge, so every request is safe to retry)
+    return client.get(path, idempotent=True)
+
+
+# Return the given command line argument as Unicode, decoded using the locale's encoding (or UTF-8,
+# if that fails, e.g. when running with the plain ASCII `C` locale).
+def decode_argument(value):
+    try:
+        return value.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return value.decode('utf-8')
+
+
+# List the library tracks matching the given (Unicode) query (or all tracks), in the same format
+# used by the input file, e.g.:
+#   lib:86d7b406b0f93a5e0993ce77b539cad2 # La Bonne Soupe > Literary Gentlemen > Oaf King, Again
+def list_library_tracks(query=u''):
+    # The track list is kept in a local index that is only updated when the library changes
+    library_index = LibraryIndex(os.path.join(args.cache_dir, 'library.sqlite'))
+    if not args.offline:
+        if library_index.refresh(client, '/musicsearch/library/listall'):
+            print('Updated library index ({0} tracks)'.format(library_index.count()))
+
+    for (uri, artist, album, title) in library_index.search(query):
+        line = u'{0} # {1} > {2} > {3}'.format(uri, artist, album, title)
+        print(line.encode('utf-8'))
+    library_index.close()
+
+
+# Return the cached metadata response for the given URI, or `None` if it needs to be fetched.
+def cached_metadata(uri):
+    if args.refresh_metadata:
+        return None
+    # When offline, an expired entry is better than nothing
+    return metadata_cache.get(uri, allow_expired=args.offline)
 
 
 # Removes extra junk from titles, e.g:
@@ -100,28 +273,128 @@ def strip_title_junk(title):
     return title
 
 
-def process_command(uri, index):
+# Create a QR code image for the given URI.
+def generate_qrcode(uri, qrout):
+    with timed_stage('qrencode'):
+        qr_encoder.write(uri, qrout)
+
+
+# Fetch the artwork (via the shared artwork cache) and copy it into the output directory (resized
+# for printing, unless `--art-dpi` is 0), returning its path relative to the output directory, or
+# `None` if the artwork isn't available (in which case the card is generated without it, and tried
+# again on the next run).  Cards that share the same artwork URL all refer to a single copy.
+def fetch_artwork(arturl):
+    with timed_stage('artwork'):
+        try:
+            return copy_artwork(artwork_cache.fetch(arturl))
+        except IOError as e:
+            # (This includes HTTP and network errors, and images that Pillow can't read)
+            print('Failed to fetch artwork {0} ({1}); generating the card without it'.format(arturl, e))
+            return None
+
+
+# Copy (or resize) the downloaded artwork at `cached_path` into the output directory.
+def copy_artwork(cached_path):
+    with output_art_locks_lock:
+        lock = output_art_locks.setdefault(cached_path, threading.Lock())
+    with lock:
+        # (The output directory is kept between runs, so also refresh any outdated copy)
+        if art_pixels:
+            artimg = 'art/' + resize_artwork(cached_path, 'out/art', art_pixels, args.art_quality)
+        else:
+            artimg = 'art/' + os.path.basename(cached_path)
+            if not os.path.exists('out/' + artimg) or os.path.getmtime('out/' + artimg) < os.path.getmtime(cached_path):
+                shutil.copyfile(cached_path, 'out/' + artimg)
+        artwork_sizes[artimg] = [os.path.getsize(cached_path), os.path.getsize('out/' + artimg)]
+    return artimg
+
+
+# Return the URL of the smallest of the given Spotify images (which come in several sizes, largest
+# first) that is still at least `art_pixels` in size, or of the largest one if none are.
+def choose_spotify_image(images):
+    if art_pixels:
+        for image in reversed(images):
+            if max(image.get('width') or 0, image.get('height') or 0) >= art_pixels:
+                return image['url']
+    return images[0]['url']
+
+
+def process_command(uri, name):
     (cmdname, arturl) = commands[uri]
     
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.jpg'.format(index)
+    # Determine the output image file name
+    qrout = 'out/{0}qr.png'.format(name)
     
     # Create a QR code from the command URI
-    print subprocess.check_output(['qrencode', '-o', qrout, uri])
+    generate_qrcode(uri, qrout)
 
     # Fetch the artwork and save to the output directory
-    print subprocess.check_output(['curl', arturl, '-o', artout])
+    artimg = fetch_artwork(arturl)
 
-    return (cmdname, None, None)
+    return (cmdname, None, None, artimg)
     
     
-def process_spotify_track(uri, index):
+# Fetch the metadata for all of the given Spotify track URIs using as few requests as possible
+# (the `tracks` endpoint accepts up to 50 IDs at a time).  The results are stored in
+# `spotify_tracks`; tracks that Spotify doesn't know about (or that aren't cached when running
+# with `--offline`) are stored as `None`.  If an entire batch fails, its tracks are left out so
+# that `process_spotify_track` can look them up individually instead.
+def prefetch_spotify_tracks(uris):
+    # Remove duplicates (while preserving order) and use cached metadata where possible
+    unique_uris = []
+    for uri in uris:
+        if uri in spotify_tracks or uri in unique_uris:
+            continue
+        track_json = cached_metadata(uri)
+        if track_json:
+            spotify_tracks[uri] = json.loads(track_json)
+        elif args.offline:
+            spotify_tracks[uri] = None
+        else:
+            unique_uris.append(uri)
+
+    if not unique_uris:
+        return
     if not sp:
         raise ValueError('Must configure Spotify API access first using `--spotify-username`')
 
-    track = sp.track(uri)
+    for i in range(0, len(unique_uris), SPOTIFY_BATCH_SIZE):
+        batch = unique_uris[i:i + SPOTIFY_BATCH_SIZE]
+        try:
+            with timed_stage('metadata'):
+                result = sp.tracks(batch)
+        except Exception as e:
+            print('Failed to fetch batch of {0} Spotify tracks ({1}); will fetch them individually'.format(len(batch), e))
+            continue
+
+        # Spotify returns the tracks in request order, with `null` in place of any unknown tracks
+        for (uri, track) in zip(batch, result['tracks']):
+            spotify_tracks[uri] = track
+            if track:
+                metadata_cache.put(uri, json.dumps(track))
 
+
+# Return the metadata for the given Spotify track URI (or `None` if the track can't be found).
+def lookup_spotify_track(uri):
+    if uri in spotify_tracks:
+        track = spotify_tracks[uri]
+    else:
+        if not sp:
+            raise ValueError('Must configure Spotify API access first using `--spotify-username`')
+        try:
+            with timed_stage('metadata'):
+                track = sp.track(uri)
+            metadata_cache.put(uri, json.dumps(track))
+        except spotipy.SpotifyException as e:
+            print('Failed to fetch Spotify track {0} ({1})'.format(uri, e))
+            track = None
+
+    if not track:
+        print('Skipping unknown Spotify track: ' + uri)
+    return track
+
+
+def process_spotify_track(uri, name, track):
     print track
     # print 'track    : ' + track['name']
     # print 'artist   : ' + track['artists'][0]['name']
@@ -131,24 +404,34 @@ def process_spotify_track(uri, index):
     song = strip_title_junk(track['name'])
     artist = strip_title_junk(track['artists'][0]['name'])
     album = strip_title_junk(track['album']['name'])
-    arturl = track['album']['images'][0]['url']
+    arturl = choose_spotify_image(track['album']['images'])
     
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.jpg'.format(index)
+    # Determine the output image file name
+    qrout = 'out/{0}qr.png'.format(name)
     
     # Create a QR code from the track URI
-    print subprocess.check_output(['qrencode', '-o', qrout, uri])
+    generate_qrcode(uri, qrout)
 
     # Fetch the artwork and save to the output directory
-    print subprocess.check_output(['curl', arturl, '-o', artout])
+    artimg = fetch_artwork(arturl)
 
-    return (song.encode('utf-8'), album.encode('utf-8'), artist.encode('utf-8'))
+    return (song.encode('utf-8'), album.encode('utf-8'), artist.encode('utf-8'), artimg)
 
 
-def process_library_track(uri, index):
-    track_json = perform_request(base_url + '/musicsearch/library/metadata/' + uri)
-    track = json.loads(track_json)
+# Return the metadata for the given library track URI (or `None` if it isn't available).
+def lookup_library_track(uri):
+    track_json = cached_metadata(uri)
+    if not track_json:
+        if args.offline:
+            print('Skipping library track that is not in the metadata cache: ' + uri)
+            return None
+        with timed_stage('metadata'):
+            track_json = perform_request('/musicsearch/library/metadata/' + uri)
+        metadata_cache.put(uri, track_json)
+    return json.loads(track_json)
+
+
+def process_library_track(uri, name, track):
     print(track)
 
     song = strip_title_junk(track['trackName'])
@@ -171,26 +454,28 @@ def process_library_track(uri, index):
     if artist_part.startswith('The%20'):
         artist = 'The ' + artist
 
-    # Determine the output image file names
-    qrout = 'out/{0}qr.png'.format(index)
-    artout = 'out/{0}art.jpg'.format(index)
+    # Determine the output image file name
+    qrout = 'out/{0}qr.png'.format(name)
 
     # Create a QR code from the track URI
-    print subprocess.check_output(['qrencode', '-o', qrout, uri])
+    generate_qrcode(uri, qrout)
 
     # Fetch the artwork and save to the output directory
-    print subprocess.check_output(['curl', arturl, '-o', artout])
+    artimg = fetch_artwork(arturl)
 
-    return (song.encode('utf-8'), album.encode('utf-8'), artist.encode('utf-8'))
+    return (song.encode('utf-8'), album.encode('utf-8'), artist.encode('utf-8'), artimg)
 
 
 # Return the HTML content for a single card.
-def card_content_html(index, artist, album, song):
-    qrimg = '{0}qr.png'.format(index)
-    artimg = '{0}art.jpg'.format(index)
+def card_content_html(name, artist, album, song, artimg):
+    qrimg = '{0}qr.png'.format(name)
 
     html = ''
-    html += '  <img src="{0}" class="art"/>\n'.format(artimg)
+    if artimg:
+        html += '  <img src="{0}" class="art"/>\n'.format(artimg)
+    else:
+        # (Keep the space for the missing artwork, so the rest of the card is laid out as usual)
+        html += '  <div class="art"></div>\n'
     html += '  <img src="{0}" class="qrcode"/>\n'.format(qrimg)
     html += '  <div class="labels">\n'
     html += '    <p class="song">{0}</p>\n'.format(song)
@@ -203,7 +488,12 @@ def card_content_html(index, artist, album, song):
 
 
 # Generate a PNG version of an individual card (with no dashed lines).
-def generate_individual_card_image(index, artist, album, song):
+def generate_individual_card_image(name, artist, album, song, artimg):
+    if card_renderer:
+        with timed_stage('image'):
+            card_renderer.render('out/{0}card.png'.format(name), 'out/' + artimg if artimg else None, 'out/{0}qr.png'.format(name), song, artist, album)
+        return
+
     # First generate an HTML file containing the individual card
     html = ''
     html += '<html>\n'
@@ -213,55 +503,152 @@ def generate_individual_card_image(index, artist, album, song):
     html += '<body>\n'
 
     html += '<div class="singlecard">\n'
-    html += card_content_html(index, artist, album, song)
+    html += card_content_html(name, artist, album, song, artimg)
     html += '</div>\n'
 
     html += '</body>\n'
     html += '</html>\n'
 
-    html_filename = 'out/{0}.html'.format(index)
+    html_filename = 'out/{0}.html'.format(name)
     with open(html_filename, 'w') as f:
         f.write(html)
 
-    # Then convert the HTML to a PNG image (beware the hardcoded values; these need to align
-    # with the dimensions in `cards.css`)
-    png_filename = 'out/{0}'.format(index)
-    print subprocess.check_output(['webkit2png', html_filename, '--scale=1.0', '--clipped', '--clipwidth=720', '--clipheight=640', '-o', png_filename])
+    # Then convert the HTML to a PNG image (`webkit2png` renders at 2x on a Retina display, so
+    # this assumes the default `--card-scale`)
+    png_filename = 'out/{0}'.format(name)
+    clipwidth = int(card_layout.width * args.card_scale)
+    clipheight = int(card_layout.height * args.card_scale)
+    with timed_stage('image'):
+        print subprocess.check_output(['webkit2png', html_filename, '--scale=1.0', '--clipped', '--clipwidth={0}'.format(clipwidth), '--clipheight={0}'.format(clipheight), '-o', png_filename])
 
     # Rename the file to remove the extra `-clipped` suffix that `webkit2png` includes by default
     os.rename(png_filename + '-clipped.png', png_filename + 'card.png')
 
 
+# Return the metadata that determines the content of the card for the given URI (or `None` if the
+# card should be skipped).
+def lookup_metadata(uri):
+    if uri.startswith('cmd:'):
+        return list(commands[uri])
+    elif uri.startswith('spotify:'):
+        return lookup_spotify_track(uri)
+    else:
+        return lookup_library_track(uri)
+
+
+# Return a hash of everything that goes into generating the given card, so that unchanged cards can
+# be detected on the next run.  (The card's position in the deck isn't included, so a card that has
+# only moved is reused as is.)
+def card_fingerprint(uri, metadata):
+    options = {
+        'images': bool(args.generate_images or args.pdf),
+        'renderer': args.renderer,
+        'card_scale': args.card_scale,
+        'qr_backend': qr_encoder.backend,
+        'art_pixels': art_pixels,
+        'art_quality': args.art_quality
+    }
+    inputs = [uri, metadata, css_hash, options]
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
+# Return the name of the output files for the card with the given fingerprint (e.g.
+# `<name>qr.png`).  Naming the outputs after the card's content rather than its position means that
+# moving a card in the deck only changes the sheet it appears on.
+def card_name(fingerprint):
+    return fingerprint[:16]
+
+
+# Process a single (index, uri) card and return `(index, entry, changed)`, where `entry` is the
+# card's manifest entry (or `None` if the card should be skipped).  Cards whose inputs haven't
+# changed since the previous run (according to the manifest) are not generated again, wherever
+# they are in the deck, and identical cards share the same outputs.  This runs on a worker thread
+# when `--jobs` is greater than one.
+def process_card(card):
+    (index, uri) = card
+
+    metadata = lookup_metadata(uri)
+    if metadata is None:
+        return (index, None, False)
+
+    fingerprint = card_fingerprint(uri, metadata)
+    with card_locks_lock:
+        lock = card_locks.setdefault(fingerprint, threading.Lock())
+    with lock:
+        existing = generated_cards.get(fingerprint) or previous_cards.get(fingerprint)
+        # (Cards generated without their artwork are generated again, in case it's available now)
+        if existing and not existing.get('missing_art') and \
+                all(os.path.exists(os.path.join('out', path)) for path in existing['outputs']):
+            return (index, existing, False)
+
+        name = card_name(fingerprint)
+        if uri.startswith('cmd:'):
+            (song, album, artist, artimg) = process_command(uri, name)
+        elif uri.startswith('spotify:'):
+            (song, album, artist, artimg) = process_spotify_track(uri, name, metadata)
+        else:
+            (song, album, artist, artimg) = process_library_track(uri, name, metadata)
+        outputs = ['{0}qr.png'.format(name)] + ([artimg] if artimg else [])
+
+        if args.generate_images or args.pdf:
+            # Also generate an individual PNG for the card
+            generate_individual_card_image(name, artist, album, song, artimg)
+            outputs.append('{0}card.png'.format(name))
+            if not card_renderer:
+                outputs.append('{0}.html'.format(name))
+
+        entry = {
+            'uri': uri,
+            'fingerprint': fingerprint,
+            'labels': [song, album, artist, artimg],
+            'outputs': outputs,
+            'art_bytes': artwork_sizes[artimg] if artimg else [0, 0]
+        }
+        if artimg:
+            generated_cards[fingerprint] = entry
+        else:
+            entry['missing_art'] = True
+        return (index, entry, True)
+
+
+# Load the manifest written by the previous run (if any).
+def load_manifest():
+    try:
+        with open('out/manifest.json') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {'cards': {}, 'files': []}
+
+    # Labels are stored as UTF-8 encoded strings while generating (JSON gives back unicode)
+    for entry in manifest['cards'].values():
+        entry['labels'] = [label.encode('utf-8') if label is not None else None for label in entry['labels']]
+    return manifest
+
+
 def generate_cards():
-    # Create the output directory
+    global previous_manifest, previous_cards, css_hash
+
+    start_time = time.time()
+
+    # Create the output directory (the contents are kept so that unchanged cards can be reused,
+    # unless `--rebuild` was given)
     dirname = os.getcwd()
     outdir = os.path.join(dirname, 'out')
     print(outdir)
-    if os.path.exists(outdir):
+    if args.rebuild and os.path.exists(outdir):
         shutil.rmtree(outdir)
-    os.mkdir(outdir)
+    if not os.path.exists(os.path.join(outdir, 'art')):
+        os.makedirs(os.path.join(outdir, 'art'))
+    previous_manifest = load_manifest()
+    previous_cards = dict((entry['fingerprint'], entry) for entry in previous_manifest['cards'].values())
 
     # Read the file containing the list of commands and songs to generate
     with open(args.input) as f:
         lines = f.readlines()
 
-    # The index of the current item being processed
-    index = 0
-
-    # Copy the CSS file into the output directory.  (Note the use of 'page-break-inside: avoid'
-    # in `cards.css`; this prevents the card divs from being spread across multiple pages
-    # when printed.)
-    shutil.copyfile('cards.css', 'out/cards.css')
-
-    # Begin the HTML template
-    html = '''
-<html>
-<head>
-  <link rel="stylesheet" href="cards.css">
-</head>
-<body>
-'''
-
+    # Collect the cards up front so that each one is assigned a fixed index (and therefore a fixed
+    # position in the output) regardless of the order in which the workers finish
+    cards = []
     for line in lines:
         # Trim newline
         line = line.strip()
@@ -272,40 +659,94 @@ def generate_cards():
         if not line:
             continue
 
-        if line.startswith('cmd:'):
-            (song, album, artist) = process_command(line, index)
-        elif line.startswith('spotify:'):
-            (song, album, artist) = process_spotify_track(line, index)
-        elif line.startswith('lib:'):
-            (song, album, artist) = process_library_track(line, index)
-        else:
+        if not line.startswith(('cmd:', 'spotify:', 'lib:')):
             print('Failed to handle URI: ' + line)
             exit(1)
+        if line.startswith('cmd:') and line not in commands:
+            print('Unknown command: {0} (for a room defined in a `qrplay` config file, pass the file with `--config`)'.format(line))
+            exit(1)
 
-        # Append the HTML for this card
-        html += '<div class="card">\n'
-        html += card_content_html(index, artist, album, song)
-        html += '</div>\n'
-
-        if args.generate_images:
-            # Also generate an individual PNG for the card
-            generate_individual_card_image(index, artist, album, song)
-
-        if index % 2 == 1:
-            html += '<br style="clear: both;"/>\n'
+        cards.append((len(cards), line))
 
-        index += 1
+    # Copy the CSS file into the output directory.  (Note the use of 'page-break-inside: avoid'
+    # in `cards.css`; this prevents the card divs from being spread across multiple pages
+    # when printed.)
+    with open('cards.css', 'rb') as f:
+        css_hash = hashlib.sha1(f.read()).hexdigest()
+    shutil.copyfile('cards.css', 'out/cards.css.tmp')
+    sheets.replace_if_changed('out/cards.css.tmp', 'out/cards.css')
+
+    # Fetch the Spotify metadata for the whole deck in bulk before any cards are processed
+    prefetch_spotify_tracks([uri for (index, uri) in cards if uri.startswith('spotify:')])
+
+    # The card HTML is written out as soon as each card is ready
+    sheet_writer = sheets.SheetWriter(outdir, args.cards_per_sheet)
+
+    # Process the cards on a pool of worker threads; `imap` yields the results in input order
+    manifest_cards = {}
+    card_images = []
+    sheet_art = {}
+    changed_count = 0
+    pool = ThreadPool(max(1, args.jobs))
+    try:
+        for (index, entry, changed) in pool.imap(process_card, cards):
+            if not entry:
+                continue
+            manifest_cards[str(index)] = entry
+            if changed:
+                changed_count += 1
+
+            (song, album, artist, artimg) = entry['labels']
+            name = card_name(entry['fingerprint'])
+            sheet_writer.add_card(card_content_html(name, artist, album, song, artimg))
+            # (Entries from before artwork was resized don't record its size)
+            sheet_art.setdefault(sheet_writer.sheets[-1], {})
+            if artimg:
+                art_bytes = entry.get('art_bytes') or [os.path.getsize('out/' + artimg)] * 2
+                sheet_art[sheet_writer.sheets[-1]][artimg] = art_bytes
+            card_images.append('out/{0}card.png'.format(name))
+    finally:
+        pool.close()
+        pool.join()
+        metadata_cache.close()
+
+    sheet_writer.close()
+    files = ['index.html', 'cards.css', 'manifest.json'] + sheet_writer.sheets
+
+    # The PDF only needs to be written again if any of the cards changed
+    if args.pdf:
+        files.append('cards.pdf')
+        # (The PDF also has to be written again if any cards were moved, added, or removed)
+        pdf_options = [args.pdf_page, card_images]
+        if changed_count or previous_manifest.get('pdf') != pdf_options or not os.path.exists('out/cards.pdf'):
+            pdf_writer = sheets.PdfWriter('out/cards.pdf', card_layout, args.card_scale, args.pdf_page)
+            for card_image in card_images:
+                pdf_writer.add_card(card_image)
+            pdf_writer.close()
+    else:
+        pdf_options = None
 
-    html += '</body>\n'
-    html += '</html>\n'
+    # Remove any outputs from the previous run that are no longer needed
+    outputs = set(files)
+    for entry in manifest_cards.values():
+        outputs.update(entry['outputs'])
+    stale = set(previous_manifest['files'])
+    for entry in previous_manifest['cards'].values():
+        stale.update(entry['outputs'])
+    for path in sorted(stale - outputs):
+        if os.path.exists(os.path.join(outdir, path)):
+            print('Removing stale output: ' + path)
+            os.remove(os.path.join(outdir, path))
 
-    print(html)
+    with open('out/manifest.json', 'w') as f:
+        json.dump({'cards': manifest_cards, 'files': files, 'pdf': pdf_options}, f, indent=1, sort_keys=True)
 
-    with open('out/index.html', 'w') as f:
-        f.write(html)
+    print('{0} of {1} cards were unchanged since the last run'.format(len(manifest_cards) - changed_count, len(manifest_cards)))
+    print_sheet_sizes(sheet_art)
+    print_stage_times(len(manifest_cards), time.time() - start_time)
 
 
 if args.input:
     generate_cards()
-elif args.list_library:
-    list_library_tracks()
+elif args.list_library or args.search:
+    list_library_tracks(decode_argument(args.search or ''))
@@ -21,38 +21,105 @@
 #
 
 import argparse
+import framesource
+from framesource import parse_roi, parse_size
 import json
-import os
-import subprocess
+from ledfeedback import DEFAULT_LED_PATH, LedFeedback
+from phrasecache import DEFAULT_TTS_COMMAND, PhraseCache
+from latency import LatencyRecorder, format_latencies, monotonic, serve_metrics
+from roomstate import RoomState, StateFile
+import re
+import Queue
+from scanfilter import ScanFilter, parse_window
 import sys
+from sonosclient import SonosClient, SonosError
+import threading
+import time
 from time import sleep
 import urllib
-import urllib2
 
 # Parse the command line arguments
 arg_parser = argparse.ArgumentParser(description='Translates QR codes detected by a camera into Sonos commands.')
 arg_parser.add_argument('--default-device', default='Dining Room', help='the name of your default device/room')
 arg_parser.add_argument('--linein-source', default='Dining Room', help='the name of the device/room used as the line-in source')
 arg_parser.add_argument('--hostname', default='localhost', help='the hostname or IP address of the machine running `node-sonos-http-api`')
-arg_parser.add_argument('--skip-load', action='store_true', help='skip loading of the music library (useful if the server has already loaded it)')
+arg_parser.add_argument('--port', type=int, default=5005, help='the port on which `node-sonos-http-api` is listening')
+arg_parser.add_argument('--timeout', type=float, default=10, help='the number of seconds to wait for a response from `node-sonos-http-api`')
+arg_parser.add_argument('--retries', type=int, default=2, help='the number of times to retry a failed request (only for requests that are safe to repeat)')
+arg_parser.add_argument('--skip-load', action='store_true', help='skip loading of the music library (by default it is only loaded if the server doesn\'t appear to have loaded it already)')
+arg_parser.add_argument('--dedupe-window', type=parse_window, action='append', default=[], metavar='PREFIX=SECONDS', help='ignore repeated scans of a code until it has been out of view for this many seconds (per code prefix, e.g. `cmd:=2`; can be given more than once)')
+arg_parser.add_argument('--queue-batch-window', type=float, help='in "build a list" mode, collect songs for up to this many seconds before adding them to the queue (defaults to 1 with `--spotify-multi-queue`, otherwise 0, since songs are then queued one request at a time anyway)')
+arg_parser.add_argument('--queue-batch-size', type=int, default=10, help='in "build a list" mode, add songs to the queue as soon as this many have been collected')
+arg_parser.add_argument('--spotify-multi-queue', action='store_true', help='queue consecutive Spotify songs with a single request (requires a bridge that accepts comma-separated URIs; falls back to one request per song otherwise)')
+arg_parser.add_argument('--state-ttl', type=float, default=30, help='the number of seconds for which the known state of a room (e.g. whether its queue is empty) is trusted, in order to skip redundant requests')
+arg_parser.add_argument('--metrics-port', type=int, help='serve scan-to-playback latency histograms (in the Prometheus text format) at http://localhost:<port>/metrics')
+arg_parser.add_argument('--metrics-host', default='127.0.0.1', help='the address the metrics endpoint listens on (e.g. 0.0.0.0 to allow scraping from other machines)')
+arg_parser.add_argument('--trace-file', help='append every latency measurement to this file (one JSON object per line)')
+arg_parser.add_argument('--frame-source', choices=['zbarcam', 'ffmpeg'], default='zbarcam', help='how codes are read from the camera: by `zbarcam`, or by decoding frames captured by `ffmpeg` in-process (requires `pyzbar` or the `zbar` Python bindings)')
+arg_parser.add_argument('--video-device', help='the camera device (e.g. /dev/video0)')
+arg_parser.add_argument('--frame-size', type=parse_size, default=(300, 200), metavar='WIDTHxHEIGHT', help='the size to which camera frames are scaled before decoding')
+arg_parser.add_argument('--roi', type=parse_roi, metavar='X,Y,WIDTH,HEIGHT', help='only decode this region of each frame (as fractions of the frame, e.g. 0.25,0.25,0.5,0.5; not supported by `zbarcam`)')
+arg_parser.add_argument('--max-decode-rate', type=float, default=0, help='decode at most this many frames per second, to save CPU (not supported by `zbarcam`)')
+arg_parser.add_argument('--replay', help='decode recorded frames (a directory of images, or a video file) instead of using the camera')
+arg_parser.add_argument('--replay-fps', type=float, default=10, help='the rate at which recorded frames are replayed (0 for as fast as possible)')
+arg_parser.add_argument('--led-path', default=DEFAULT_LED_PATH, help='the sysfs directory of the LED used for feedback')
+arg_parser.add_argument('--clips-dir', help='pre-render spoken phrases as clips in this directory (the bridge\'s `static/clips` folder) and play those instead of using text-to-speech each time')
+arg_parser.add_argument('--tts-command', default=DEFAULT_TTS_COMMAND, help='the command used to render a phrase to a WAV file, with {path} and {text} placeholders')
+arg_parser.add_argument('--phrase-cache-size', type=int, default=50, help='the number of clips to keep for phrases that aren\'t known in advance')
+arg_parser.add_argument('--config', help='run one scanner per room, as described by this JSON file (see README)')
 arg_parser.add_argument('--debug-file', help='read commands from a file instead of launching scanner')
+arg_parser.add_argument('--debug-delay', type=float, default=4, help='the number of seconds to wait after each command read from the debug file')
+arg_parser.add_argument('--debug-speed', type=float, default=1, help='replay the debug file this many times faster than its timestamps (and `--debug-delay`) say, or 0 for as fast as possible')
+arg_parser.add_argument('--debug-max-rate', type=float, default=0, help='queue at most this many codes per second from the debug file (0 for no limit)')
 args = arg_parser.parse_args()
 print args
 
 
-base_url = 'http://' + args.hostname + ':5005'
-
-# Load the most recently used device, if available, otherwise fall back on the `default-device` argument
-try:
-    with open('.last-device', 'r') as device_file:
-        current_device = device_file.read().replace('\n', '')
-        print('Defaulting to last used room: ' + current_device)
-except:
-    current_device = args.default_device
-    print('Initial room: ' + current_device)
-
-# Keep track of the last-seen code
-last_qrcode = ''
+# All requests (from every scanner) share a pool of keep-alive connections to the bridge
+client = SonosClient(args.hostname, args.port, timeout=args.timeout, retries=args.retries)
+
+# Loading the library can take much longer than a typical request
+LIBRARY_LOAD_TIMEOUT = 300
+
+# Records the bridge and a library track that was last played successfully from it, so that on the
+# next launch a cheap metadata lookup of that track can tell whether the library is still loaded
+LIBRARY_STATE_FILE = '.library-ready'
+
+# The commands that switch to another room, and the room each one switches to (can be overridden
+# by the `rooms` section of the config file)
+DEFAULT_ROOM_COMMANDS = {
+    'cmd:livingroom': 'Living Room',
+    'cmd:diningandkitchen': 'Dining Room'
+}
+
+# Everything qrocodile says (rendered in advance when `--clips-dir` is given), by name
+PHRASES = {
+    'hello': 'Hello, I\'m qrocodile.',
+    'loading': 'Please give me a moment to gather my thoughts.',
+    'ready': 'I\'m ready now!',
+    'showcard': 'Show me a card!',
+    'turntable': 'I\'ve activated the turntable',
+    'songonly': 'Show me a card and I\'ll play that song right away',
+    'wholealbum': 'Show me a card and I\'ll play the whole album',
+    'buildqueue': 'Let\'s build a list of songs',
+    'unknown': 'Hmm, I don\'t recognize that command'
+}
+SWITCH_ROOM_PHRASE = 'I\'m switching to the {0}'
+
+# Changes to the current room are written out at most once every few seconds
+STATE_SAVE_DELAY = 2
+
+# Latency of each stage between a code being scanned and the bridge acknowledging the resulting
+# command (all measured with the monotonic clock), per command type and room
+latency = LatencyRecorder('qrplay_', args.trace_file)
+latency.define('queue_wait_seconds', 'Time from a code being scanned until it is dispatched')
+latency.define('handle_seconds', 'Time spent handling a dispatched code')
+latency.define('scan_to_ack_seconds', 'Time from a code being scanned until the bridge has acknowledged the resulting command(s)')
+latency.define('request_seconds', 'Duration of each request to the bridge')
+latency.define('scan_to_feedback_seconds', 'Time from a code being scanned until the LED starts blinking')
+
+# The latencies (and their labels) reported at the end of a debug file replay
+REPLAY_SUMMARY_METRICS = [('queue_wait_seconds', 'queue wait'), ('scan_to_ack_seconds', 'scan to ack'), ('request_seconds', 'request')]
 
 
 class Mode:
@@ -60,211 +127,737 @@ class Mode:
     PLAY_ALBUM_IMMEDIATELY = 2
     BUILD_QUEUE = 3
 
-current_mode = Mode.PLAY_SONG_IMMEDIATELY
 
+# Scanners start right away, while the library is loaded in the background.  Library cards scanned
+# before it's ready (and any codes scanned after them, so that each room's codes are still handled
+# in order) are held until `LIBRARY_READY` comes through each scan queue.
+library_ready = threading.Event()
+LIBRARY_READY = object()
 
-def perform_request(url):
-    print(url)
-    response = urllib2.urlopen(url)
-    result = response.read()
+# The known state of each room, shared by all sessions (several scanners can control one room)
+room_states = {}
+room_states_lock = threading.Lock()
+
+
+# Send a request to the bridge.  Only requests that can safely be repeated (e.g. `pauseall`, as
+# opposed to `next`) should be marked as `idempotent`, since only those are retried on failure.
+def perform_request(path, idempotent=False, timeout=None, room=''):
+    print(client.base_url() + path)
+    start = monotonic()
+    try:
+        result = client.get(path, idempotent=idempotent, timeout=timeout)
+    finally:
+        latency.observe_since('request_seconds', start, action=request_action(path, room), room=room)
     print(result)
+    return result
 
 
-def perform_global_request(path):
-    perform_request(base_url + '/' + path)
-
-
-def perform_room_request(path):
-    qdevice = urllib.quote(current_device)
-    perform_request(base_url + '/' + qdevice + '/' + path)
-
-
-def switch_to_room(room):
-    global current_device
-
-    perform_global_request('pauseall')
-    current_device = room
-    with open(".last-device", "w") as device_file:
-        device_file.write(current_device)
-
-
-def speak(phrase):
-    print('SPEAKING: \'{0}\''.format(phrase))
-    perform_room_request('say/' + urllib.quote(phrase))
-
-
-# Causes the onboard green LED to blink on and off twice.  (This assumes Raspberry Pi 3 Model B; your
-# mileage may vary.)
-def blink_led():
-    duration = 0.15
-
-    def led_off():
-        subprocess.call("echo 0 > /sys/class/leds/led0/brightness", shell=True)
-
-    def led_on():
-        subprocess.call("echo 1 > /sys/class/leds/led0/brightness", shell=True)
-
-    # Technically we only need to do this once when the script launches
-    subprocess.call("echo none > /sys/class/leds/led0/trigger", shell=True)
-
-    led_on()
-    sleep(duration)
-    led_off()
-    sleep(duration)
-    led_on()
-    sleep(duration)
-    led_off()
-
-
-def handle_command(qrcode):
-    global current_mode
-
-    print('HANDLING COMMAND: ' + qrcode)
-
-    if qrcode == 'cmd:playpause':
-        perform_room_request('playpause')
-        phrase = None
-    elif qrcode == 'cmd:next':
-        perform_room_request('next')
-        phrase = None
-    elif qrcode == 'cmd:turntable':
-        perform_room_request('linein/' + urllib.quote(args.linein_source))
-        perform_room_request('play')
-        phrase = 'I\'ve activated the turntable'
-    elif qrcode == 'cmd:livingroom':
-        switch_to_room('Living Room')
-        phrase = 'I\'m switching to the living room'
-    elif qrcode == 'cmd:diningandkitchen':
-        switch_to_room('Dining Room')
-        phrase = 'I\'m switching to the dining room'
-    elif qrcode == 'cmd:songonly':
-        current_mode = Mode.PLAY_SONG_IMMEDIATELY
-        phrase = 'Show me a card and I\'ll play that song right away'
-    elif qrcode == 'cmd:wholealbum':
-        current_mode = Mode.PLAY_ALBUM_IMMEDIATELY
-        phrase = 'Show me a card and I\'ll play the whole album'
-    elif qrcode == 'cmd:buildqueue':
-        current_mode = Mode.BUILD_QUEUE
-        #perform_room_request('pause')
-        perform_room_request('clearqueue')
-        phrase = 'Let\'s build a list of songs'
-    elif qrcode == 'cmd:whatsong':
-        perform_room_request('saysong')
-        phrase = None
-    elif qrcode == 'cmd:whatnext':
-        perform_room_request('saynext')
-        phrase = None
-    else:
-        phrase = 'Hmm, I don\'t recognize that command'
+def perform_global_request(path, idempotent=False, timeout=None):
+    return perform_request('/' + path, idempotent, timeout)
 
-    if phrase:
-        speak(phrase)
 
+# Return the action of the given request path without its arguments (the room, a URI, a phrase,
+# etc.), e.g. `spotify/queue` for `/Dining%20Room/spotify/queue/spotify:track:...`.
+def request_action(path, room):
+    segments = path.split('/')[2 if room else 1:]
+    action = []
+    for segment in segments:
+        if not re.match('^[a-z]+$', segment):
+            break
+        action.append(segment)
+    return '/'.join(action)
 
-def handle_library_item(uri):
-    if not uri.startswith('lib:'):
-        return
 
-    print('PLAYING FROM LIBRARY: ' + uri)
+# Return the number of seconds to collect songs for before queueing them.  Collecting them only pays
+# off when several Spotify songs can be queued with a single request.
+def queue_batch_window():
+    if args.queue_batch_window is not None:
+        return args.queue_batch_window
+    return 1.0 if args.spotify_multi_queue else 0
 
-    if current_mode == Mode.BUILD_QUEUE:
-        action = 'queuesongfromhash'
-    elif current_mode == Mode.PLAY_ALBUM_IMMEDIATELY:
-        action = 'playalbumfromhash'
-    else:
-        action = 'playsongfromhash'
 
-    perform_room_request('musicsearch/library/{0}/{1}'.format(action, uri))
+# Return the command type used to label the latency of the given code.
+def command_type(qrcode):
+    if qrcode.startswith('cmd:'):
+        return qrcode
+    elif qrcode.startswith('spotify:'):
+        return 'spotify'
+    else:
+        return 'library'
 
 
-def handle_spotify_item(uri):
-    print('PLAYING FROM SPOTIFY: ' + uri)
+def get_room_state(room):
+    with room_states_lock:
+        if room not in room_states:
+            room_states[room] = RoomState(args.state_ttl)
+        return room_states[room]
 
-    if current_mode == Mode.BUILD_QUEUE:
-        action = 'queue'
-    elif current_mode == Mode.PLAY_ALBUM_IMMEDIATELY:
-        action = 'clearqueueandplayalbum'
-    else:
-        action = 'clearqueueandplaysong'
 
-    perform_room_request('spotify/{0}/{1}'.format(action, uri))
+def load_library_state():
+    try:
+        return json.loads(library_state_file.read())
+    except:
+        return {}
 
 
-def handle_qrcode(qrcode):
-    global last_qrcode
+# Remember that the library on this bridge was loaded (and that the given track was in it).
+def save_library_state(uri):
+    global library_state
 
-    # Ignore redundant codes, except for commands like "whatsong", where you might
-    # want to perform it multiple times
-    if qrcode == last_qrcode and not qrcode.startswith('cmd:'):
-        print('IGNORING REDUNDANT QRCODE: ' + qrcode)
-        return
+    state = {'bridge': client.base_url(), 'probe': uri}
+    if library_state != state:
+        library_state = state
+        library_state_file.write(json.dumps(state))
 
-    print('HANDLING QRCODE: ' + qrcode)
 
-    if qrcode.startswith('cmd:'):
-        handle_command(qrcode)
-    elif qrcode.startswith('spotify:'):
-        handle_spotify_item(qrcode)
+# Return true if the bridge appears to have loaded the library already, i.e. if it can still find
+# the track that was last played from it.  (The lookup fails while the library isn't loaded.)
+def library_is_loaded():
+    state = library_state
+    if state.get('bridge') != client.base_url() or not state.get('probe'):
+        return False
+    try:
+        result = json.loads(perform_global_request('musicsearch/library/metadata/' + state['probe'], idempotent=True))
+    except Exception as e:
+        print('Library probe failed ({0})'.format(e))
+        return False
+    return isinstance(result, dict) and result.get('status') != 'error'
+
+
+# The state of one scanner and the room it controls.  Each session has its own scan queue and
+# dispatch thread, so that a slow response from the bridge never stops the scanner output from
+# being read.  Codes are handed from the scanner thread to the dispatch thread through `scan_queue`
+# as (code, scan time) tuples (a `None` marks the end of the input).  Since there's a single
+# dispatch thread per session, a scanner's commands are always sent in the order they were scanned.
+class Session(object):
+    def __init__(self, name, room, state_file, device=None, replay=None, debug_file=None, linein_source=None, room_commands=None, pause_all=True):
+        self.name = name
+        self.device = device
+        self.replay = replay
+        self.debug_file = debug_file
+        self.linein_source = linein_source or args.linein_source
+        self.room_commands = room_commands or DEFAULT_ROOM_COMMANDS
+        # A scanner that shares the bridge with scanners in other rooms only pauses its own room
+        self.pause_all = pause_all
+        self.state_file = StateFile(state_file, STATE_SAVE_DELAY)
+
+        # Load the most recently used device, if available, otherwise fall back on the given room
+        try:
+            self.room = self.state_file.read().replace('\n', '')
+            self.log('Defaulting to last used room: ' + self.room)
+        except:
+            self.room = room
+            self.log('Initial room: ' + self.room)
+
+        self.mode = Mode.PLAY_SONG_IMMEDIATELY
+
+        # Collapse repeated scans of the same card into a single event
+        self.scan_filter = ScanFilter(dict(args.dedupe_window))
+        self.scan_queue = Queue.Queue()
+        self.source = None
+
+        # In BUILD_QUEUE mode, songs are collected into a batch of (kind, uri, scan time) tuples on
+        # the dispatch thread and added to the queue together, once the batch is full or
+        # `queue_batch_window` seconds after the first song was scanned (whichever comes first)
+        self.queue_batch = []
+        self.queue_batch_deadline = 0
+
+        self.held_scans = []
+        self.scans_read = 0
+        self.read_time = 0
+
+    def log(self, message):
+        if self.name:
+            print('[{0}] {1}'.format(self.name, message))
+        else:
+            print(message)
+
+    def perform_room_request(self, path, idempotent=False, timeout=None):
+        qdevice = urllib.quote(self.room)
+        return perform_request('/' + qdevice + '/' + path, idempotent, timeout, room=self.room)
+
+    def room_state(self):
+        return get_room_state(self.room)
+
+    # Return the state of the current room, for a decision that depends on the given facts.  If any
+    # of them are unknown or stale, a refresh is started so that they're known next time (this time
+    # the caller just sends the request that might otherwise have been skipped).
+    def check_room_state(self, *names):
+        state = self.room_state()
+        if state.is_stale(*names):
+            self.refresh_room_state()
+        return state
+
+    # Fetch the state of the current room on a background thread, so that it's known by the time
+    # the next code is scanned.
+    def refresh_room_state(self):
+        room = self.room
+        state = get_room_state(room)
+        if not state.begin_refresh():
+            return
+
+        def refresh():
+            since = time.time()
+            response = None
+            try:
+                response = json.loads(perform_request('/' + urllib.quote(room) + '/state', idempotent=True, room=room))
+            except Exception as e:
+                self.log('FAILED TO REFRESH ROOM STATE: {0}'.format(e))
+            state.update(response, since)
+        start_thread(refresh)
+
+    def pause(self):
+        if self.pause_all:
+            perform_global_request('pauseall', idempotent=True)
+            with room_states_lock:
+                states = room_states.values()
+            for state in states:
+                state.set(playing=False)
+        elif self.check_room_state('playing').get('playing') is False:
+            self.log('SKIPPING PAUSE: ' + self.room + ' is not playing')
+        else:
+            self.perform_room_request('pause', idempotent=True)
+            self.room_state().set(playing=False)
+
+    def switch_to_room(self, room):
+        if room == self.room:
+            self.log('ALREADY IN ROOM: ' + room)
+            return
+        self.pause()
+        self.room = room
+        self.state_file.write(self.room)
+
+    def speak(self, phrase):
+        clip = phrase_cache.lookup(phrase) if phrase_cache else None
+        if clip:
+            self.log('SPEAKING: \'{0}\' (from {1})'.format(phrase, clip))
+            try:
+                self.perform_room_request('clip/' + urllib.quote(clip))
+                return
+            except SonosError as e:
+                self.log('FAILED TO PLAY CLIP, FALLING BACK TO SAY: {0}'.format(e))
+        else:
+            self.log('SPEAKING: \'{0}\''.format(phrase))
+        self.perform_room_request('say/' + urllib.quote(phrase))
+
+    # Handle the given command, returning false if it isn't recognized.
+    def handle_command(self, qrcode):
+        self.log('HANDLING COMMAND: ' + qrcode)
+
+        recognized = True
+
+        if qrcode == 'cmd:playpause':
+            self.perform_room_request('playpause')
+            self.room_state().forget('playing')
+            self.refresh_room_state()
+            phrase = None
+        elif qrcode == 'cmd:next':
+            self.perform_room_request('next')
+            self.room_state().forget('track')
+            self.refresh_room_state()
+            phrase = None
+        elif qrcode == 'cmd:turntable':
+            self.perform_room_request('linein/' + urllib.quote(self.linein_source), idempotent=True)
+            self.perform_room_request('play', idempotent=True)
+            self.room_state().forget('track')
+            self.room_state().set(playing=True)
+            phrase = PHRASES['turntable']
+        elif qrcode in self.room_commands:
+            self.switch_to_room(self.room_commands[qrcode])
+            phrase = SWITCH_ROOM_PHRASE.format(self.room.lower())
+        elif qrcode == 'cmd:songonly':
+            self.mode = Mode.PLAY_SONG_IMMEDIATELY
+            phrase = PHRASES['songonly']
+        elif qrcode == 'cmd:wholealbum':
+            self.mode = Mode.PLAY_ALBUM_IMMEDIATELY
+            phrase = PHRASES['wholealbum']
+        elif qrcode == 'cmd:buildqueue':
+            self.mode = Mode.BUILD_QUEUE
+            #self.perform_room_request('pause')
+            if self.room_state().get('queue_empty'):
+                self.log('SKIPPING CLEARQUEUE: the queue is already empty')
+            else:
+                self.perform_room_request('clearqueue', idempotent=True)
+                self.room_state().set(queue_empty=True, track='', playing=False)
+            phrase = PHRASES['buildqueue']
+        elif qrcode == 'cmd:whatsong':
+            self.perform_room_request('saysong')
+            phrase = None
+        elif qrcode == 'cmd:whatnext':
+            self.perform_room_request('saynext')
+            phrase = None
+        else:
+            phrase = PHRASES['unknown']
+            recognized = False
+
+        if phrase:
+            self.speak(phrase)
+        return recognized
+
+    def handle_library_item(self, uri, scanned_at):
+        if not uri.startswith('lib:'):
+            return
+
+        if self.mode == Mode.BUILD_QUEUE:
+            self.add_to_queue_batch('lib', uri, scanned_at)
+            return
+
+        if self.skip_replay(uri):
+            return
+
+        self.log('PLAYING FROM LIBRARY: ' + uri)
+
+        if self.mode == Mode.PLAY_ALBUM_IMMEDIATELY:
+            action = 'playalbumfromhash'
+        else:
+            action = 'playsongfromhash'
+
+        self.perform_room_request('musicsearch/library/{0}/{1}'.format(action, uri), idempotent=True)
+        self.started_playing(uri)
+        save_library_state(uri)
+
+    def handle_spotify_item(self, uri, scanned_at):
+        if self.mode == Mode.BUILD_QUEUE:
+            self.add_to_queue_batch('spotify', uri, scanned_at)
+            return
+
+        if self.skip_replay(uri):
+            return
+
+        self.log('PLAYING FROM SPOTIFY: ' + uri)
+
+        if self.mode == Mode.PLAY_ALBUM_IMMEDIATELY:
+            action = 'clearqueueandplayalbum'
+        else:
+            action = 'clearqueueandplaysong'
+
+        self.perform_room_request('spotify/{0}/{1}'.format(action, uri), idempotent=True)
+        self.started_playing(uri)
+
+    # Return true if the given song is already playing (in which case playing it again would only
+    # restart it).
+    def skip_replay(self, uri):
+        if self.mode == Mode.PLAY_SONG_IMMEDIATELY and self.check_room_state('playing', 'track').is_playing(uri):
+            self.log('ALREADY PLAYING: ' + uri)
+            return True
+        return False
+
+    def started_playing(self, uri):
+        if self.mode == Mode.PLAY_SONG_IMMEDIATELY:
+            self.room_state().set(track=uri, playing=True, queue_empty=False)
+        else:
+            # (The current track is the first track of the album)
+            self.room_state().forget('track')
+            self.room_state().set(playing=True, queue_empty=False)
+
+    def add_to_queue_batch(self, kind, uri, scanned_at):
+        self.log('ADDING TO QUEUE BATCH: ' + uri)
+        if not self.queue_batch:
+            self.queue_batch_deadline = time.time() + queue_batch_window()
+        self.queue_batch.append((kind, uri, scanned_at))
+
+    # Add the batch of collected songs to the queue, in the order they were scanned.  (Each song
+    # already blinked the LED when it was added to the batch; any song that fails to be queued
+    # blinks it again, as an error.)  The requests are sent back to back over the client's
+    # keep-alive connections (they can't be sent concurrently, since the bridge would then queue
+    # them in whatever order they arrive).  Queueing isn't idempotent, so a failed request isn't
+    # retried, but it doesn't prevent the rest of the batch from being queued.
+    def flush_queue_batch(self):
+        batch = self.queue_batch
+        self.queue_batch = []
+        self.log('QUEUEING {0} SONG(S)'.format(len(batch)))
+
+        i = 0
+        while i < len(batch):
+            (kind, uri, scanned_at) = batch[i]
+
+            if kind == 'spotify' and args.spotify_multi_queue:
+                # Queue the run of consecutive Spotify songs starting here with a single request
+                run = []
+                while i + len(run) < len(batch) and batch[i + len(run)][0] == 'spotify':
+                    run.append(batch[i + len(run)])
+                if len(run) > 1:
+                    try:
+                        queued = self.queue_spotify_songs([item[1] for item in run])
+                    except Exception as e:
+                        self.log('FAILED TO QUEUE: {0} ({1})'.format(','.join(item[1] for item in run), e))
+                        led.play('error')
+                        i += len(run)
+                        continue
+                    if queued:
+                        self.song_queued(run)
+                        i += len(run)
+                        continue
+
+            try:
+                if kind == 'lib':
+                    self.perform_room_request('musicsearch/library/queuesongfromhash/' + uri)
+                    save_library_state(uri)
+                else:
+                    self.perform_room_request('spotify/queue/' + uri)
+                self.song_queued([batch[i]])
+            except Exception as e:
+                self.log('FAILED TO QUEUE: {0} ({1})'.format(uri, e))
+                led.play('error')
+            i += 1
+
+    # Record that the given (kind, uri, scan time) songs have been added to the queue.
+    def song_queued(self, songs):
+        self.room_state().set(queue_empty=False)
+        for (kind, uri, scanned_at) in songs:
+            latency.observe_since('scan_to_ack_seconds', scanned_at, command=command_type(uri), room=self.room)
+
+    # Queue several Spotify songs with one request.  If the bridge rejects the request, multi-song
+    # requests are turned off and false is returned (so the songs are queued one at a time instead).
+    # Any other error (e.g. a timeout, after which the songs may or may not have been queued) is
+    # raised.
+    def queue_spotify_songs(self, uris):
+        try:
+            self.perform_room_request('spotify/queue/' + ','.join(uris))
+            return True
+        except SonosError as e:
+            self.log('Bridge does not support queueing multiple Spotify songs ({0})'.format(e))
+            args.spotify_multi_queue = False
+            return False
+
+    def handle_qrcode(self, qrcode, scanned_at):
+        self.log('HANDLING QRCODE: ' + qrcode)
+
+        # (The room is the one the code was handled in, even if the code switches to another room)
+        room = self.room
+        batched = self.mode == Mode.BUILD_QUEUE and qrcode.startswith(('lib:', 'spotify:'))
+        start = monotonic()
+        latency.observe('queue_wait_seconds', start - scanned_at, command=command_type(qrcode), room=room)
+
+        if qrcode.startswith('cmd:'):
+            recognized = self.handle_command(qrcode)
+        elif qrcode.startswith('spotify:'):
+            self.handle_spotify_item(qrcode, scanned_at)
+            recognized = True
+        else:
+            self.handle_library_item(qrcode, scanned_at)
+            recognized = qrcode.startswith('lib:')
+
+        latency.observe_since('handle_seconds', start, command=command_type(qrcode), room=room)
+        if not batched:
+            # (Songs added to a batch are only acknowledged once the batch has been queued)
+            latency.observe_since('scan_to_ack_seconds', scanned_at, command=command_type(qrcode), room=room)
+
+        # Blink the onboard LED to give some visual indication that a code was handled
+        # (especially useful for cases where there's no other auditory feedback, like
+        # when adding songs to the queue)
+        led.play('success' if recognized else 'unknown')
+        latency.observe_since('scan_to_feedback_seconds', scanned_at)
+
+    # Queue a scanned code for dispatch, unless it's a repeat of a recent scan (as of `seen_at`, in
+    # seconds, which defaults to now).
+    def queue_scan(self, qrcode, scanned_at, seen_at=None):
+        if self.scan_filter.accept(qrcode, seen_at):
+            self.scan_queue.put((qrcode, scanned_at))
+        else:
+            self.log('IGNORING REDUNDANT QRCODE: ' + qrcode)
+
+    # Start reading codes from this session's scanner (or debug file) on a background thread.
+    def start_input(self):
+        if self.debug_file:
+            # Run through a list of codes from a local file
+            start_thread(self.read_debug_script)
+        else:
+            # Start the QR code reader
+            kind = 'replay' if self.replay else args.frame_source
+            self.source = framesource.open_source(kind, self.device, self.replay, args.frame_size, args.roi,
+                                                  args.max_decode_rate, args.replay_fps)
+            start_thread(self.start_scan)
+
+    def stop_input(self):
+        if self.source:
+            self.source.close()
+            self.log('Scanner: ' + self.source.stats.summary())
+
+    # Monitor the codes read by the QR code scanner, queueing each one for dispatch.
+    def start_scan(self):
+        for (qrcode, scanned_at) in self.source.codes():
+            self.queue_scan(qrcode, scanned_at)
+        # The scanner has exited (or the recorded frames have run out)
+        self.scan_queue.put(None)
+
+    # Read from the `debug.txt` file and queue one code at a time.  The file is streamed, so it can
+    # be as long as a load test needs.  Each line holds a code, optionally preceded by a timestamp
+    # in seconds (e.g. a `zbarcam` session recorded with `zbarcam | ts %.s`, in which case the codes
+    # also have zbarcam's `QR-Code:` prefix).  Timestamped codes are queued with the same spacing as
+    # they were recorded with, and other codes are followed by a `--debug-delay` pause, both scaled
+    # by `--debug-speed`.
+    def read_debug_script(self):
+        speed = args.debug_speed
+        due = started = monotonic()
+        last_queued = None
+        first_timestamp = None
+
+        with open(self.debug_file) as f:
+            for line in f:
+                # Remove any trailing comments and newline (and skip empty or comment-only lines)
+                line = line.split("#")[0]
+                line = line.strip()
+                if not line:
+                    continue
+                (timestamp, code) = parse_debug_line(line)
+                if not code:
+                    continue
+
+                if speed and timestamp is not None:
+                    if first_timestamp is None:
+                        first_timestamp = (timestamp, due)
+                    due = first_timestamp[1] + (timestamp - first_timestamp[0]) / speed
+                if args.debug_max_rate and last_queued is not None:
+                    due = max(due, last_queued + 1.0 / args.debug_max_rate)
+                delay = due - monotonic()
+                if delay > 0:
+                    sleep(delay)
+
+                # (Repeats are judged by the recorded time, so de-duplication works as it did when
+                # the trace was recorded, however fast it's replayed)
+                last_queued = monotonic()
+                self.scans_read += 1
+                self.queue_scan(code, last_queued, timestamp)
+                if speed and timestamp is None:
+                    due = max(due, last_queued) + args.debug_delay / speed
+        self.read_time = monotonic() - started
+        self.scan_queue.put(None)
+
+    # Handle queued codes until the end of the input.
+    def dispatch_scans(self):
+        while True:
+            if self.queue_batch:
+                # Wait for more songs until the batch is full or its time is up
+                timeout = self.queue_batch_deadline - time.time()
+                if timeout <= 0 or len(self.queue_batch) >= args.queue_batch_size:
+                    self.flush_queue_batch()
+                    continue
+                try:
+                    scan = self.scan_queue.get(timeout=timeout)
+                except Queue.Empty:
+                    self.flush_queue_batch()
+                    continue
+            else:
+                scan = self.scan_queue.get()
+
+            if scan is LIBRARY_READY:
+                scans = self.held_scans[:]
+                del self.held_scans[:]
+                for held_scan in scans:
+                    self.dispatch_scan(*held_scan)
+                continue
+            if scan is None:
+                # Handle any held codes before finishing (once the library has been loaded)
+                library_ready.wait()
+                for held_scan in self.held_scans:
+                    self.dispatch_scan(*held_scan)
+                if self.queue_batch:
+                    self.flush_queue_batch()
+                break
+            if self.held_scans or (scan[0].startswith('lib:') and not library_ready.is_set()):
+                self.log('HOLDING UNTIL THE LIBRARY IS LOADED: ' + scan[0])
+                self.held_scans.append(scan)
+                continue
+            self.dispatch_scan(*scan)
+
+    def dispatch_scan(self, qrcode, scanned_at):
+        # Anything other than another song for the queue (e.g. a command) is only handled once the
+        # songs scanned before it have been queued
+        if self.queue_batch and (self.mode != Mode.BUILD_QUEUE or not qrcode.startswith(('lib:', 'spotify:'))):
+            self.flush_queue_batch()
+
+        try:
+            self.handle_qrcode(qrcode, scanned_at)
+        except Exception as e:
+            # Don't let one failed command (e.g. the bridge being unreachable) stop the dispatcher
+            self.log('FAILED TO HANDLE QRCODE: {0} ({1})'.format(qrcode, e))
+            led.play('error')
+
+
+# Return the (timestamp or `None`, code) from a line of the debug file, which is either
+# `[<timestamp>] <code>` or a line of `zbarcam` output (`QR-Code:<code>`).  The code is `None` for a
+# `zbarcam` line for some other kind of symbol.
+def parse_debug_line(line):
+    parts = line.split(None, 1)
+    timestamp = None
+    if len(parts) == 2:
+        try:
+            timestamp = float(parts[0])
+            line = parts[1]
+        except ValueError:
+            pass
+    if line.startswith('QR-Code:') or re.match('^[A-Z][A-Za-z0-9-]*:', line):
+        # (Codes themselves, e.g. `cmd:next`, are lowercase)
+        return (timestamp, framesource.parse_zbar_line(line))
+    return (timestamp, line)
+
+
+# Print the throughput and latency of a debug file replay.
+def print_replay_summary(elapsed):
+    scans = sum(session.scans_read for session in sessions)
+    read_time = max(session.read_time for session in sessions)
+    acknowledged = latency.sample_counts['scan_to_ack_seconds']
+    print('Replayed {0} scans in {1:.2f}s ({2:.1f}/s offered), {3} acknowledged in {4:.2f}s ({5:.1f}/s)'.format(
+        scans, read_time, scans / read_time if read_time else 0, acknowledged, elapsed, acknowledged / elapsed if elapsed else 0))
+    for (name, label) in REPLAY_SUMMARY_METRICS:
+        print('  {0:<12} {1}'.format(label, format_latencies(latency.samples[name])))
+
+
+# Return the sessions described by the config file, which looks like:
+#
+#   {
+#     "rooms": {"cmd:kitchen": "Kitchen", "cmd:den": "Den"},
+#     "scanners": [
+#       {"name": "kitchen", "device": "/dev/video0", "room": "Kitchen"},
+#       {"name": "den", "device": "/dev/video1", "room": "Den", "linein_source": "Den"}
+#     ]
+#   }
+#
+# Each scanner's current room is remembered in its own `.last-device-<name>` file (or `state_file`).
+# A scanner can decode recorded frames (`replay`) or read codes from a `debug_file` instead of
+# using a camera.  `rooms` (the room switching
+# commands) is optional, and defaults to the standard living room/dining room commands.
+def load_sessions(path):
+    with open(path, 'r') as config_file:
+        config = json.load(config_file)
+
+    # JSON strings come back as Unicode, while everything else (the command line, the codes read
+    # from the scanner) is UTF-8 encoded
+    def utf8(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+
+    if config.get('rooms'):
+        room_commands = dict((utf8(uri), utf8(room)) for (uri, room) in config['rooms'].items())
     else:
-        handle_library_item(qrcode)
-
-    # Blink the onboard LED to give some visual indication that a code was handled
-    # (especially useful for cases where there's no other auditory feedback, like
-    # when adding songs to the queue)
-    if not args.debug_file:
-        blink_led()
-        
-    last_qrcode = qrcode
-
-
-# Monitor the output of the QR code scanner.
-def start_scan():
-    while True:
-        data = p.readline()
-        qrcode = str(data)[8:]
-        if qrcode:
-            qrcode = qrcode.rstrip()
-            handle_qrcode(qrcode)
-
-
-# Read from the `debug.txt` file and handle one code at a time.
-def read_debug_script():
-    # Read codes from `debug.txt`
-    with open(args.debug_file) as f:
-        debug_codes = f.readlines()
-
-    # Handle each code followed by a short delay
-    for code in debug_codes:
-        # Remove any trailing comments and newline (and ignore any empty or comment-only lines)
-        code = code.split("#")[0]
-        code = code.strip()
-        if code:
-            handle_qrcode(code)
-            sleep(4)
-
-
-perform_global_request('pauseall')
-speak('Hello, I\'m qrocodile.')
-
-if not args.skip_load:
-    # Preload library on startup (it takes a few seconds to prepare the cache)
-    print('Indexing the library...')
-    speak('Please give me a moment to gather my thoughts.')
-    perform_room_request('musicsearch/library/loadifneeded')
-    print('Indexing complete!')
-    speak('I\'m ready now!')
-
-speak('Show me a card!')
-
-if args.debug_file:
-    # Run through a list of codes from a local file
-    read_debug_script()
+        room_commands = DEFAULT_ROOM_COMMANDS
+    sessions = []
+    for scanner in config['scanners']:
+        name = utf8(scanner['name'])
+        if any(session.name == name for session in sessions):
+            raise ValueError('Duplicate scanner name in {0}: {1}'.format(path, name))
+        sessions.append(Session(name,
+                                room=utf8(scanner.get('room', args.default_device)),
+                                state_file=utf8(scanner.get('state_file', '.last-device-' + name)),
+                                device=utf8(scanner.get('device')),
+                                replay=utf8(scanner.get('replay')),
+                                debug_file=utf8(scanner.get('debug_file')),
+                                linein_source=utf8(scanner.get('linein_source')),
+                                room_commands=room_commands,
+                                pause_all=scanner.get('pause_all', False)))
+    return sessions
+
+
+# Greet and load the library (if needed), while the scanners and dispatchers are already running.
+def warm_up(sessions):
+    def speak_everywhere(phrase):
+        for session in sessions:
+            try:
+                session.speak(phrase)
+            except Exception as e:
+                session.log('FAILED TO GREET: {0}'.format(e))
+
+    def release_held_scans():
+        library_ready.set()
+        for session in sessions:
+            session.scan_queue.put(LIBRARY_READY)
+
+    if not library_ready.is_set() and library_is_loaded():
+        print('Library is already loaded')
+        release_held_scans()
+
+    speak_everywhere(PHRASES['hello'])
+
+    if not library_ready.is_set():
+        try:
+            # Preload library on startup (it takes a few seconds to prepare the cache)
+            print('Indexing the library...')
+            speak_everywhere(PHRASES['loading'])
+            sessions[0].perform_room_request('musicsearch/library/loadifneeded', idempotent=True, timeout=LIBRARY_LOAD_TIMEOUT)
+            print('Indexing complete!')
+            speak_everywhere(PHRASES['ready'])
+        except Exception as e:
+            # Release any held cards anyway; they'll be played if the library becomes available
+            print('FAILED TO LOAD LIBRARY: {0}'.format(e))
+        release_held_scans()
+
+    speak_everywhere(PHRASES['showcard'])
+
+
+def start_thread(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+if args.config:
+    # Run one scanner per room
+    sessions = load_sessions(args.config)
 else:
-    # Start the QR code reader
-    p = os.popen('/usr/bin/zbarcam --prescale=300x200', 'r')
-    try:
-        start_scan()
-    except KeyboardInterrupt:
-        print('Stopping scanner...')
-    finally:
-        p.close()
+    sessions = [Session('', room=args.default_device, state_file='.last-device', device=args.video_device,
+                        replay=args.replay, debug_file=args.debug_file)]
+
+# Render everything that can be said ahead of time (in the background; until a phrase has been
+# rendered it's spoken the usual way)
+if args.clips_dir:
+    phrase_cache = PhraseCache(args.clips_dir, args.tts_command, args.phrase_cache_size)
+    known_phrases = set(PHRASES.values())
+    for session in sessions:
+        known_phrases.update(SWITCH_ROOM_PHRASE.format(room.lower()) for room in session.room_commands.values())
+    phrase_cache.prepare(sorted(known_phrases))
+else:
+    phrase_cache = None
+
+# Report the latencies at the end of a replay (from `--debug-file`, or a scanner's `debug_file`)
+replaying = any(session.debug_file for session in sessions)
+if replaying:
+    latency.keep_samples([name for (name, label) in REPLAY_SUMMARY_METRICS])
+
+# The LED is shared by all scanners
+led = LedFeedback(args.led_path)
+library_state_file = StateFile(LIBRARY_STATE_FILE, STATE_SAVE_DELAY)
+library_state = load_library_state()
+
+if args.skip_load:
+    library_ready.set()
+
+if args.metrics_port:
+    serve_metrics(latency, args.metrics_port, args.metrics_host)
+
+# Start reading codes right away (the camera takes a moment to start up), but only start handling
+# them once everything has been paused
+started = monotonic()
+for session in sessions:
+    session.start_input()
+
+paused = set()
+for session in sessions:
+    target = None if session.pause_all else session.room
+    if target not in paused:
+        paused.add(target)
+        try:
+            session.pause()
+        except Exception as e:
+            session.log('FAILED TO PAUSE: {0}'.format(e))
+
+dispatchers = [start_thread(session.dispatch_scans) for session in sessions]
+start_thread(lambda: warm_up(sessions))
+
+try:
+    # (Joining with a timeout keeps the main thread responsive to Ctrl-C)
+    for dispatcher in dispatchers:
+        while dispatcher.is_alive():
+            dispatcher.join(0.5)
+except KeyboardInterrupt:
+    print('Stopping scanner...')
+finally:
+    for session in sessions:
+        session.stop_input()
+        session.state_file.flush()
+        session.log('Scans accepted: {0}, suppressed as repeats: {1}'.format(session.scan_filter.accepted, session.scan_filter.suppressed))
+    if replaying:
+        print_replay_summary(monotonic() - started)
+    library_state_file.flush()
+    led.close()
+    latency.close()
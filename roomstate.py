@@ -0,0 +1,139 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+
+import os
+import threading
+import time
+import urllib
+
+
+# What qrplay knows about the playback state of one room: whether its queue is empty, the URI of
+# the current track, and whether it's playing.  Each fact is learned either from a request that was
+# just sent (e.g. after `clearqueue` the queue is known to be empty) or from the bridge's
+# `/<room>/state` endpoint, and is only trusted for `ttl` seconds, since the room can also be
+# controlled from elsewhere (e.g. the Sonos app).  A fact that is unknown or stale reads as `None`.
+class RoomState(object):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # {name: (value, time learned)}
+        self.facts = {}
+        self.refreshing = False
+
+    def get(self, name):
+        with self.lock:
+            fact = self.facts.get(name)
+            if fact is None or time.time() - fact[1] > self.ttl:
+                return None
+            return fact[0]
+
+    def set(self, **facts):
+        now = time.time()
+        with self.lock:
+            for (name, value) in facts.items():
+                self.facts[name] = (value, now)
+
+    def forget(self, *names):
+        with self.lock:
+            for name in names:
+                self.facts.pop(name, None)
+
+    # Return true if any of the given facts are unknown or stale.
+    def is_stale(self, *names):
+        return any(self.get(name) is None for name in names)
+
+    # Return true if the given URI (e.g. `spotify:track:...`) is known to be playing.
+    def is_playing(self, uri):
+        track = self.get('track')
+        return bool(self.get('playing') and track and uri in urllib.unquote(track))
+
+    # Return true if the caller should refresh the facts from the bridge (i.e. if no other refresh
+    # is already in progress), in which case it must call `update()` when done.
+    def begin_refresh(self):
+        with self.lock:
+            if self.refreshing:
+                return False
+            self.refreshing = True
+            return True
+
+    # Update the facts from a `/<room>/state` response (or `None` if the request failed) that was
+    # requested at time `since`.  Facts learned since then are newer than the response, so they're
+    # kept.  (The state doesn't say whether the queue is empty, only that it isn't if there's a next
+    # track.)
+    def update(self, state, since):
+        with self.lock:
+            self.refreshing = False
+            if state is None:
+                return
+            facts = {
+                'playing': state.get('playbackState') == 'PLAYING',
+                'track': (state.get('currentTrack') or {}).get('uri') or ''
+            }
+            if (state.get('nextTrack') or {}).get('uri'):
+                facts['queue_empty'] = False
+            for (name, value) in facts.items():
+                fact = self.facts.get(name)
+                if fact is None or fact[1] < since:
+                    self.facts[name] = (value, time.time())
+
+
+# Writes a small state file (e.g. `.last-device`) at most once every `delay` seconds, however often
+# it changes, by writing to a temporary file and renaming it into place (so that a crash or power
+# loss never leaves a truncated file behind).
+class StateFile(object):
+    def __init__(self, path, delay):
+        self.path = path
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.data = None
+        self.timer = None
+
+    def read(self):
+        with open(self.path, 'r') as f:
+            return f.read()
+
+    def write(self, data):
+        with self.lock:
+            self.data = data
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    # Write out any pending change now.
+    def flush(self):
+        with self.lock:
+            (timer, self.timer) = (self.timer, None)
+            (data, self.data) = (self.data, None)
+        if timer and timer is not threading.current_thread():
+            # (Wait for the cancelled timer thread to finish, so it isn't left behind at exit)
+            timer.cancel()
+            timer.join()
+        if data is None:
+            return
+        with self.write_lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.rename(temp_path, self.path)
@@ -0,0 +1,87 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import time
+
+# The default de-duplication windows (in seconds) for each kind of code.  Command cards get a short
+# window so that they can be repeated quickly (e.g. skipping several songs), while song cards get a
+# longer one so that a card left in front of the camera doesn't restart the song.
+DEFAULT_WINDOWS = {
+    'cmd:': 2.0,
+    'lib:': 10.0,
+    'spotify:': 10.0
+}
+
+# The window for codes that don't match any of the prefixes
+DEFAULT_WINDOW = 10.0
+
+
+# Suppresses repeated scans of the same code.  The scanner reports a code on every frame in which it
+# can be decoded, so a card held in front of the camera produces a burst of identical scans; only
+# the first scan in a burst is accepted.  A burst ends once the code hasn't been seen for the length
+# of its window (which depends on the code's prefix), after which the same card can trigger again.
+class ScanFilter(object):
+    def __init__(self, windows=None, default_window=DEFAULT_WINDOW):
+        self.windows = dict(DEFAULT_WINDOWS)
+        self.windows.update(windows or {})
+        self.default_window = default_window
+        self.last_seen = {}
+
+        # The number of accepted and suppressed scans for each prefix
+        self.accepted = {}
+        self.suppressed = {}
+
+    def prefix(self, code):
+        matches = [prefix for prefix in self.windows if code.startswith(prefix)]
+        return max(matches, key=len) if matches else ''
+
+    def window(self, code):
+        return self.windows.get(self.prefix(code), self.default_window)
+
+    # Return true if the given scan should be handled, or false if it's part of a burst.
+    def accept(self, code, now=None):
+        if now is None:
+            now = time.time()
+
+        last = self.last_seen.get(code)
+        self.last_seen[code] = now
+        if len(self.last_seen) > 1000:
+            self.prune(now)
+
+        prefix = self.prefix(code)
+        if last is not None and now - last < self.window(code):
+            self.suppressed[prefix] = self.suppressed.get(prefix, 0) + 1
+            return False
+        self.accepted[prefix] = self.accepted.get(prefix, 0) + 1
+        return True
+
+    # Forget about codes whose windows have expired.
+    def prune(self, now):
+        for (code, last) in self.last_seen.items():
+            if now - last >= self.window(code):
+                del self.last_seen[code]
+
+
+# Parse a `PREFIX=SECONDS` window argument.
+def parse_window(value):
+    (prefix, seconds) = value.rsplit('=', 1)
+    return (prefix, float(seconds))
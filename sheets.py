@@ -0,0 +1,213 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import io
+import os
+
+# Pillow is optional; it's only needed for PDF output
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+# Page sizes (in inches) supported for PDF output
+PAGE_SIZES = {
+    'letter': (8.5, 11.0),
+    'a4': (8.27, 11.69)
+}
+
+# CSS pixels per inch
+CSS_DPI = 96.0
+
+
+# Move the file at `temp_path` to `path`, unless `path` already has the same contents (in which
+# case it's left untouched and the temporary file is removed).
+def replace_if_changed(temp_path, path):
+    if os.path.exists(path):
+        with open(temp_path, 'rb') as f:
+            new_data = f.read()
+        with open(path, 'rb') as f:
+            old_data = f.read()
+        if new_data == old_data:
+            os.remove(temp_path)
+            return
+    os.rename(temp_path, path)
+
+
+# Writes the card HTML out to a series of fixed-size sheet files (`index-001.html`,
+# `index-002.html`, ...) as the cards are produced, and finishes with an `index.html` that links to
+# each sheet.
+class SheetWriter(object):
+    def __init__(self, outdir, cards_per_sheet):
+        self.outdir = outdir
+        self.cards_per_sheet = cards_per_sheet
+        self.sheets = []
+        self.sheet_file = None
+        self.sheet_card_count = 0
+
+    def add_card(self, card_html):
+        if not self.sheet_file:
+            self.begin_sheet()
+
+        self.sheet_file.write('<div class="card">\n')
+        self.sheet_file.write(card_html)
+        self.sheet_file.write('</div>\n')
+
+        if self.sheet_card_count % 2 == 1:
+            self.sheet_file.write('<br style="clear: both;"/>\n')
+
+        self.sheet_card_count += 1
+        if self.sheet_card_count == self.cards_per_sheet:
+            self.end_sheet()
+
+    def begin_sheet(self):
+        name = 'index-{0:03d}.html'.format(len(self.sheets) + 1)
+        self.sheets.append(name)
+        # (Sheets that are identical to the existing files are left alone)
+        self.sheet_path = os.path.join(self.outdir, name)
+        self.sheet_file = open(self.sheet_path + '.tmp', 'w')
+        self.sheet_file.write('<html>\n<head>\n  <link rel="stylesheet" href="cards.css">\n</head>\n<body>\n')
+        self.sheet_card_count = 0
+
+    def end_sheet(self):
+        self.sheet_file.write('</body>\n</html>\n')
+        self.sheet_file.close()
+        self.sheet_file = None
+        replace_if_changed(self.sheet_path + '.tmp', self.sheet_path)
+
+    # Finish the last sheet and write the `index.html` page.
+    def close(self):
+        if self.sheet_file:
+            self.end_sheet()
+
+        index_path = os.path.join(self.outdir, 'index.html')
+        with open(index_path + '.tmp', 'w') as f:
+            f.write('<html>\n<head>\n  <link rel="stylesheet" href="cards.css">\n</head>\n<body>\n')
+            f.write('<ul>\n')
+            for name in self.sheets:
+                f.write('  <li><a href="{0}">{0}</a></li>\n'.format(name))
+            f.write('</ul>\n')
+            f.write('</body>\n</html>\n')
+        replace_if_changed(index_path + '.tmp', index_path)
+
+
+# Writes card images to a print-ready PDF, with as many cards per page as fit at actual size and a
+# dashed cutting guide around each card.  Each page is written out as soon as it's full, so only one
+# page is ever held in memory.
+class PdfWriter(object):
+    def __init__(self, path, layout, scale, page='letter'):
+        if not Image:
+            raise ValueError('PDF output requires the `Pillow` package (`pip install Pillow`)')
+
+        (page_width, page_height) = PAGE_SIZES[page]
+        self.page_points = (page_width * 72, page_height * 72)
+        self.dpi = CSS_DPI * scale
+        self.page_pixels = (int(page_width * self.dpi), int(page_height * self.dpi))
+        self.card_pixels = (int(layout.width * scale), int(layout.height * scale))
+        self.columns = self.page_pixels[0] // self.card_pixels[0]
+        self.rows = self.page_pixels[1] // self.card_pixels[1]
+        self.margins = ((self.page_pixels[0] - self.columns * self.card_pixels[0]) // 2,
+                        (self.page_pixels[1] - self.rows * self.card_pixels[1]) // 2)
+
+        self.f = open(path, 'wb')
+        self.f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        # Objects 1 and 2 (the catalog and page tree) are written last, once all pages are known
+        self.offsets = {}
+        self.next_id = 3
+        self.page_ids = []
+        self.page = None
+        self.page_card_count = 0
+
+    def add_card(self, card_path):
+        if not self.page:
+            self.page = Image.new('RGB', self.page_pixels, 'white')
+            self.page_card_count = 0
+
+        (column, row) = (self.page_card_count % self.columns, self.page_card_count // self.columns)
+        x = self.margins[0] + column * self.card_pixels[0]
+        y = self.margins[1] + row * self.card_pixels[1]
+        card = Image.open(card_path).convert('RGB').resize(self.card_pixels, Image.ANTIALIAS)
+        self.page.paste(card, (x, y))
+        self.draw_cutting_guide(x, y)
+
+        self.page_card_count += 1
+        if self.page_card_count == self.columns * self.rows:
+            self.write_page()
+
+    def draw_cutting_guide(self, x, y):
+        draw = ImageDraw.Draw(self.page)
+        (w, h) = self.card_pixels
+        dash = int(self.dpi / 24)
+        width = max(1, int(self.dpi / CSS_DPI))
+        for i in range(0, max(w, h), dash * 2):
+            if i < w:
+                draw.line([(x + i, y), (x + min(i + dash, w), y)], fill='#999999', width=width)
+                draw.line([(x + i, y + h), (x + min(i + dash, w), y + h)], fill='#999999', width=width)
+            if i < h:
+                draw.line([(x, y + i), (x, y + min(i + dash, h))], fill='#999999', width=width)
+                draw.line([(x + w, y + i), (x + w, y + min(i + dash, h))], fill='#999999', width=width)
+
+    def write_object(self, body, stream=None):
+        object_id = self.next_id
+        self.next_id += 1
+        self.write_object_with_id(object_id, body, stream)
+        return object_id
+
+    def write_object_with_id(self, object_id, body, stream=None):
+        self.offsets[object_id] = self.f.tell()
+        self.f.write('{0} 0 obj\n{1}\n'.format(object_id, body).encode('ascii'))
+        if stream is not None:
+            self.f.write(b'stream\n')
+            self.f.write(stream)
+            self.f.write(b'\nendstream\n')
+        self.f.write(b'endobj\n')
+
+    def write_page(self):
+        jpeg = io.BytesIO()
+        self.page.save(jpeg, 'JPEG', quality=90, dpi=(self.dpi, self.dpi))
+        jpeg = jpeg.getvalue()
+        image_id = self.write_object(
+            '<< /Type /XObject /Subtype /Image /Width {0} /Height {1} /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {2} >>'.format(
+                self.page_pixels[0], self.page_pixels[1], len(jpeg)), jpeg)
+        content = 'q {0:.2f} 0 0 {1:.2f} 0 0 cm /Im0 Do Q'.format(self.page_points[0], self.page_points[1]).encode('ascii')
+        content_id = self.write_object('<< /Length {0} >>'.format(len(content)), content)
+        page_id = self.write_object(
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0:.2f} {1:.2f}] /Resources << /XObject << /Im0 {2} 0 R >> >> /Contents {3} 0 R >>'.format(
+                self.page_points[0], self.page_points[1], image_id, content_id))
+        self.page_ids.append(page_id)
+        self.page = None
+
+    def close(self):
+        if self.page:
+            self.write_page()
+
+        kids = ' '.join('{0} 0 R'.format(page_id) for page_id in self.page_ids)
+        self.write_object_with_id(2, '<< /Type /Pages /Kids [{0}] /Count {1} >>'.format(kids, len(self.page_ids)))
+        self.write_object_with_id(1, '<< /Type /Catalog /Pages 2 0 R >>')
+
+        xref_offset = self.f.tell()
+        self.f.write('xref\n0 {0}\n'.format(self.next_id).encode('ascii'))
+        self.f.write(b'0000000000 65535 f \n')
+        for object_id in range(1, self.next_id):
+            self.f.write('{0:010d} 00000 n \n'.format(self.offsets[object_id]).encode('ascii'))
+        self.f.write('trailer\n<< /Size {0} /Root 1 0 R >>\nstartxref\n{1}\n%%EOF\n'.format(self.next_id, xref_offset).encode('ascii'))
+        self.f.close()
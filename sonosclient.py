@@ -0,0 +1,130 @@
+#
+# Copyright (c) 2018 Chris Campbell
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+import errno
+import httplib
+import Queue
+import socket
+import time
+
+
+# Raised when the bridge responds with an error status.
+class SonosError(Exception):
+    def __init__(self, path, status, body):
+        Exception.__init__(self, 'Request for {0} failed with status {1}'.format(path, status))
+        self.path = path
+        self.status = status
+        self.body = body
+
+
+# Return true if the given error shows that an idle keep-alive connection had already been closed
+# by the bridge, so that the request sent on it never arrived.  (A timeout doesn't count: the bridge
+# may well have received the request and just be slow to respond.)
+def connection_was_closed(e):
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    if isinstance(e, socket.timeout):
+        return False
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+# A client for `node-sonos-http-api` that keeps a pool of persistent (keep-alive) connections, so
+# that most requests don't pay for a new TCP connection.  Requests time out after `timeout`
+# seconds.  Requests marked as idempotent are retried up to `retries` times (with exponential
+# backoff, capped at `max_backoff` seconds) if the connection fails or the bridge reports a server
+# error.  A client can be shared between threads.
+class SonosClient(object):
+    def __init__(self, hostname, port=5005, timeout=10, retries=2, backoff=0.25, max_backoff=2.0, max_idle=4):
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.idle = Queue.LifoQueue(max_idle)
+
+    def base_url(self):
+        return 'http://{0}:{1}'.format(self.hostname, self.port)
+
+    def connection(self, timeout):
+        try:
+            conn = self.idle.get_nowait()
+            conn.sock.settimeout(timeout)
+            return (conn, True)
+        except Queue.Empty:
+            return (httplib.HTTPConnection(self.hostname, self.port, timeout=timeout), False)
+
+    def release(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+    # Send a GET request for the given path (e.g. `/pauseall`) and return the response once the
+    # headers have been received.  The caller must read the body and then pass the response to
+    # `finish`.  Responses with a status listed in `ok_statuses` are returned; any other status
+    # raises `SonosError`.
+    def open(self, path, headers={}, idempotent=True, timeout=None, ok_statuses=(200,)):
+        timeout = timeout or self.timeout
+        attempt = 0
+        while True:
+            (conn, reused) = self.connection(timeout)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                # A pooled connection may have been closed by the bridge while it was idle, in
+                # which case the request never arrived and can safely be sent again right away
+                if reused and connection_was_closed(e):
+                    continue
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                response.connection = conn
+                if response.status in ok_statuses:
+                    return response
+                body = response.read()
+                self.finish(response)
+                if response.status < 500 or not idempotent or attempt >= self.retries:
+                    raise SonosError(path, response.status, body)
+
+            time.sleep(min(self.backoff * (2 ** attempt), self.max_backoff))
+            attempt += 1
+
+    # Return the connection used for a response (whose body has been read) to the pool.
+    def finish(self, response):
+        if response.will_close:
+            response.connection.close()
+        else:
+            self.release(response.connection)
+
+    # Send a GET request for the given path and return the response body.
+    def get(self, path, idempotent=True, timeout=None):
+        response = self.open(path, idempotent=idempotent, timeout=timeout)
+        try:
+            body = response.read()
+        except:
+            response.connection.close()
+            raise
+        self.finish(response)
+        return body